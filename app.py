@@ -1,23 +1,48 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import (Flask, Blueprint, Response, render_template, request, redirect, url_for, flash, session, abort,
+                   jsonify, current_app, g, has_request_context, stream_template, stream_with_context)
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 import os
 from dotenv import load_dotenv
 from urllib.parse import urlparse
 from datetime import datetime, date, timedelta
 from psycopg2.extras import RealDictCursor
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from io import StringIO
+import csv
 import re
+import json
+import select
+import threading
+import time
+import gzip
+from markupsafe import Markup
+
+try:
+    import brotli  # optional: pip install brotli
+except ImportError:
+    brotli = None
+
+from archive import ArchiveReadOnly, sales_relation
+from mapping_sync import bump_mapping_version, rebuild_plu_consumption
+from worker import enqueue_job
 
 load_dotenv()
 
-app = Flask(__name__)
-app.secret_key = os.getenv("SECRET_KEY", "fallbacksecret")
+bp = Blueprint("main", __name__)
 
-DATABASE_URL = os.getenv("DATABASE_URL")
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "30"))
+REPLICA_CHECK_SECONDS = float(os.getenv("REPLICA_CHECK_SECONDS", "10"))
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "60"))
 
-def get_conn():
-    url = urlparse(DATABASE_URL)
-    return psycopg2.connect(
+APP_NAME = "machine-reporting"
+
+def connect_params(dsn):
+    url = urlparse(dsn)
+    return dict(
         host=url.hostname,
         dbname=url.path[1:],
         user=url.username,
@@ -25,12 +50,250 @@ def get_conn():
         port=url.port
     )
 
+def connect(dsn, **kwargs):
+    """Open an unpooled connection to dsn. Inside a request it is tagged with the
+    endpoint (application_name "machine-reporting:<endpoint>") so pg_stat_activity,
+    and loadtest.py, can attribute connections to routes."""
+    if has_request_context() and "application_name" not in kwargs:
+        kwargs["application_name"] = f"{APP_NAME}:{request.endpoint}"
+    return psycopg2.connect(**connect_params(dsn), **kwargs)
+
+# ---------------------------
+# Connection pool
+# ---------------------------
+# One pool per app and database ("primary", "replica"), created on first use
+# (or by the warm-up). DB_POOL_MIN connections stay open between requests; up to
+# DB_POOL_MAX can be checked out at once, past that requests get a plain
+# connection. DB_POOL_MAX=0 turns pooling off. A checked-out connection carries
+# its endpoint in application_name like connect()'s; idle ones show
+# "machine-reporting:pool".
+class PooledConnection:
+    """A pooled connection whose close() gives it back to the pool (rolling back
+    anything left open and resetting application_name) instead of closing it, so
+    routes keep calling close(). Routes that return early without closing hand it
+    back when it is collected, as a plain connection would be closed."""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            broken = bool(conn.closed)
+            if not broken:
+                try:
+                    conn.rollback()
+                    set_application_name(conn, None)
+                except psycopg2.Error:
+                    broken = True
+            self._pool.putconn(conn, close=broken)
+
+    def __del__(self):
+        try:
+            self.close()
+        except psycopg2.pool.PoolError:
+            pass
+
+def db_pool(name):
+    config = current_app.config
+    if not config["DB_POOL_MAX"]:
+        return None
+    pools = current_app.extensions["db_pools"]
+    if name not in pools:
+        with current_app.extensions["db_pools_lock"]:
+            if name not in pools:
+                dsn = config["DATABASE_URL"] if name == "primary" else config["REPLICA_DATABASE_URL"]
+                extra = {"connect_timeout": 2} if name == "replica" else {}
+                pools[name] = psycopg2.pool.ThreadedConnectionPool(
+                    config["DB_POOL_MIN"], config["DB_POOL_MAX"], application_name=f"{APP_NAME}:pool",
+                    **connect_params(dsn), **extra)
+    return pools[name]
+
+def set_application_name(conn, name):
+    """SET (or with None, RESET) application_name outside any transaction."""
+    conn.autocommit = True
+    cur = conn.cursor()
+    if name is None:
+        cur.execute("RESET application_name")
+    else:
+        cur.execute("SET application_name = %s", (name,))
+    cur.close()
+    conn.autocommit = False
+
+def pooled_conn(name):
+    """A PooledConnection from the named pool, or None when pooling is off or the pool is exhausted."""
+    pool = db_pool(name)
+    if pool is None:
+        return None
+    try:
+        conn = pool.getconn()
+    except psycopg2.pool.PoolError:
+        return None
+    if has_request_context() and request.endpoint:
+        try:
+            set_application_name(conn, f"{APP_NAME}:{request.endpoint}")
+        except psycopg2.Error:
+            pool.putconn(conn, close=True)
+            return None
+    return PooledConnection(pool, conn)
+
+def get_conn():
+    """Primary connection: every write, and reads that must see them."""
+    return pooled_conn("primary") or connect(current_app.config["DATABASE_URL"])
+
+# ---------------------------
+# Read routing
+# ---------------------------
+# Report and dashboard reads go to REPLICA_DATABASE_URL when it is set and no
+# more than REPLICA_MAX_LAG_SECONDS behind; the check is cached per process for
+# REPLICA_CHECK_SECONDS. After a user saves something their reads stay on the
+# primary for READ_YOUR_WRITES_SECONDS so they see their own change. Reports
+# reaching archived months need a temp table, which a hot standby cannot create:
+# sales_relation() raises ArchiveReadOnly there and the view is run again with
+# its reads on the primary (retry_on_primary).
+REPLICA_STATUS_SQL = """
+    SELECT
+        CASE WHEN NOT pg_is_in_recovery() THEN 0
+             WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+             ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END AS lag_seconds
+"""
+
+replica_lock = threading.Lock()
+replica_status = {"checked_at": 0.0, "usable": False, "lag_seconds": None}
+
+def check_replica():
+    """Cached replica health: usable when reachable and within the lag limit."""
+    with replica_lock:
+        if time.monotonic() - replica_status["checked_at"] < REPLICA_CHECK_SECONDS:
+            return dict(replica_status)
+        replica_status["checked_at"] = time.monotonic()
+        try:
+            conn = connect(current_app.config["REPLICA_DATABASE_URL"], connect_timeout=2)
+            try:
+                cur = conn.cursor()
+                cur.execute(REPLICA_STATUS_SQL)
+                lag, = cur.fetchone()
+                cur.close()
+            finally:
+                conn.close()
+        except psycopg2.Error as e:
+            current_app.logger.warning("Replica unavailable, reading from primary: %s", e)
+            replica_status.update(usable=False, lag_seconds=None)
+            return dict(replica_status)
+        replica_status.update(usable=float(lag) <= REPLICA_MAX_LAG_SECONDS, lag_seconds=float(lag))
+        if not replica_status["usable"]:
+            current_app.logger.warning("Replica %.0fs behind, reading from primary", lag)
+        return dict(replica_status)
+
+def note_write():
+    """Pin this user's reads to the primary for a while after they change data."""
+    session["last_write_at"] = time.time()
+
+def recently_wrote():
+    return has_request_context() and time.time() - session.get("last_write_at", 0) < READ_YOUR_WRITES_SECONDS
+
+def get_read_conn():
+    """Connection for report reads: the replica when configured, healthy and fresh
+    enough, otherwise the primary."""
+    if not current_app.config["REPLICA_DATABASE_URL"] or recently_wrote() or g.get("reads_on_primary"):
+        return get_conn()
+    if not check_replica()["usable"]:
+        return get_conn()
+    try:
+        conn = pooled_conn("replica") or connect(current_app.config["REPLICA_DATABASE_URL"], connect_timeout=2)
+    except psycopg2.OperationalError as e:
+        current_app.logger.warning("Replica connect failed, reading from primary: %s", e)
+        with replica_lock:
+            replica_status["usable"] = False
+        return get_conn()
+    conn.set_session(readonly=True)
+    return conn
+
+@bp.errorhandler(ArchiveReadOnly)
+def retry_on_primary(e):
+    """Run the view again with every read on the primary (reads have no side effects)."""
+    if g.get("reads_on_primary"):
+        raise e
+    g.reads_on_primary = True
+    return current_app.ensure_sync(current_app.view_functions[request.endpoint])(**request.view_args)
+
+# ---------------------------
+# Compression
+# ---------------------------
+# Smallest body worth compressing per mimetype; anything else goes out as is.
+# Streamed responses (drill-down, CSV streams, SSE) are never buffered here.
+COMPRESS_MIN_BYTES = {
+    "text/html": 2048,
+    "text/csv": 1024,
+    "application/json": 1024,
+}
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+
+@bp.after_app_request
+def compress_response(response):
+    threshold = COMPRESS_MIN_BYTES.get(response.mimetype)
+    if (threshold is None or response.status_code != 200 or response.is_streamed
+            or response.direct_passthrough or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    if brotli and request.accept_encodings["br"]:
+        encoding = "br"
+    elif request.accept_encodings["gzip"]:
+        encoding = "gzip"
+    else:
+        return response
+    data = response.get_data()
+    if len(data) < threshold:
+        return response
+    if encoding == "br":
+        response.set_data(brotli.compress(data, quality=min(COMPRESS_LEVEL, 11)))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=COMPRESS_LEVEL))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+# ---------------------------
+# Store / device lists
+# ---------------------------
+# The form pickers' SELECT DISTINCT over sales_transactions, cached per process
+# for LIST_CACHE_SECONDS (config); a store's first sales show up within that window.
+LIST_SQL = {
+    "stores": "SELECT DISTINCT store_id FROM sales_transactions WHERE store_id IS NOT NULL ORDER BY store_id",
+    "devices": "SELECT DISTINCT device_id FROM sales_transactions WHERE device_id IS NOT NULL ORDER BY device_id",
+}
+list_cache = {}
+list_cache_lock = threading.Lock()
+
+def cached_list(cur, name):
+    with list_cache_lock:
+        cached = list_cache.get(name)
+    if cached and time.monotonic() - cached[0] < current_app.config["LIST_CACHE_SECONDS"]:
+        return cached[1]
+    c = cur.connection.cursor()
+    c.execute(LIST_SQL[name])
+    values = [row[0] for row in c.fetchall()]
+    c.close()
+    with list_cache_lock:
+        list_cache[name] = (time.monotonic(), values)
+    return values
+
+def list_stores(cur):
+    return cached_list(cur, "stores")
+
+def list_devices(cur):
+    return cached_list(cur, "devices")
+
 # ---------------------------
 # Dashboard
 # ---------------------------
-@app.route("/")
+@bp.route("/")
 def dashboard():
-    conn = get_conn()
+    conn = get_read_conn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     cur.execute("""
         SELECT date, time, source, device_id, plu_code, product_name, quantity, amount
@@ -47,7 +310,49 @@ def dashboard():
 # ---------------------------
 # Mapping
 # ---------------------------
-@app.route("/mapping/33nozzle", methods=["GET", "POST"])
+# Rendered mapping tables, per process, keyed by mapping_versions.version.
+# Every write to a mapping table bumps its version (mapping_sync.bump_mapping_version).
+mapping_fragments = {}
+mapping_fragments_lock = threading.Lock()
+
+MAPPING_TABLES = {
+    "nozzle_mapping": ("""
+        SELECT id, store_id, plu_code, ingredient_name, volume, created_at
+        FROM nozzle_mapping
+        ORDER BY store_id, plu_code, ingredient_name
+    """, "_mapping_nozzle_table.html"),
+    "robobar_mapping": ("""
+        SELECT * FROM robobar_mapping
+        ORDER BY store_id, plu_code
+    """, "_mapping_robobar_table.html"),
+    "vending_mapping": ("""
+        SELECT id, device_id, slot, plu_code, product_name, store_id, multiplier, is_main, created_at
+        FROM vending_mapping
+        ORDER BY device_id, slot, plu_code
+    """, "_mapping_vending_table.html"),
+}
+
+def mapping_fragment(cur, table):
+    """The rendered mapping table for `table`; its query and render only run
+    when the table's version has moved since the last render. `cur` may use any
+    cursor_factory whose rows the template can read by column name."""
+    sql, template = MAPPING_TABLES[table]
+    c = cur.connection.cursor()
+    c.execute("SELECT version FROM mapping_versions WHERE name = %s", (table,))
+    row = c.fetchone()
+    c.close()
+    version = row[0] if row else 0
+    with mapping_fragments_lock:
+        cached = mapping_fragments.get(table)
+    if cached and cached[0] == version:
+        return cached[1]
+    cur.execute(sql)
+    html = Markup(render_template(template, mappings=cur.fetchall()))
+    with mapping_fragments_lock:
+        mapping_fragments[table] = (version, html)
+    return html
+
+@bp.route("/mapping/33nozzle", methods=["GET", "POST"])
 def mapping_nozzle():
     conn = get_conn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -69,13 +374,16 @@ def mapping_nozzle():
                 SET volume = EXCLUDED.volume
             """, (store_id, plu_code, ing.strip(), float(vol)))
 
+        rebuild_plu_consumption(cur, [store_id])
+        bump_mapping_version(cur, "nozzle_mapping")
         conn.commit()
+        note_write()
+        live_nozzle.reset()
         flash(f"✅ Mapping saved for {plu_code} (store {store_id})", "success")
-        return redirect(url_for("mapping_nozzle"))
+        return redirect(url_for("main.mapping_nozzle"))
 
     # Stores
-    cur.execute("SELECT DISTINCT store_id FROM sales_transactions WHERE store_id IS NOT NULL ORDER BY store_id")
-    stores = [row[0] for row in cur.fetchall()]
+    stores = list_stores(cur)
 
     # Unmapped PLUs
     cur.execute("""
@@ -93,12 +401,7 @@ def mapping_nozzle():
     unmapped = cur.fetchall()
 
     # Existing mappings
-    cur.execute("""
-        SELECT id, store_id, plu_code, ingredient_name, volume, created_at
-        FROM nozzle_mapping
-        ORDER BY store_id, plu_code, ingredient_name
-    """)
-    mappings = cur.fetchall()
+    mapping_table = mapping_fragment(cur, "nozzle_mapping")
 
     cur.close()
     conn.close()
@@ -106,10 +409,10 @@ def mapping_nozzle():
     return render_template("mapping_nozzle.html",
                            stores=stores,
                            unmapped=unmapped,
-                           mappings=mappings)
+                           mapping_table=mapping_table)
 
 
-@app.route("/mapping/33nozzle/delete", methods=["POST"])
+@bp.route("/mapping/33nozzle/delete", methods=["POST"])
 def delete_mappings_nozzle():
     ids = request.form.getlist("ids[]")  # comes from checkboxes
     if ids:
@@ -117,22 +420,26 @@ def delete_mappings_nozzle():
         cur = conn.cursor()
         # cast ids to integers
         ids = [int(x) for x in ids]
-        cur.execute("DELETE FROM nozzle_mapping WHERE id = ANY(%s)", (ids,))
+        cur.execute("DELETE FROM nozzle_mapping WHERE id = ANY(%s) RETURNING store_id", (ids,))
+        rebuild_plu_consumption(cur, {row[0] for row in cur.fetchall()})
+        bump_mapping_version(cur, "nozzle_mapping")
         conn.commit()
+        note_write()
+        live_nozzle.reset()
         cur.close()
         conn.close()
         flash(f"❌ Deleted {len(ids)} mappings", "warning")
     else:
         flash("⚠️ No mappings selected for deletion", "danger")
 
-    return redirect(url_for("mapping_nozzle"))
+    return redirect(url_for("main.mapping_nozzle"))
 
 
 
 # ---------------------------
 # Stock
 # ---------------------------
-@app.route("/stock", methods=["GET", "POST"])
+@bp.route("/stock", methods=["GET", "POST"])
 def stock():
     conn = get_conn()
     cur = conn.cursor()
@@ -153,12 +460,12 @@ def stock():
             """, (store_id, date, ing, rep))
 
         conn.commit()
+        note_write()
         flash(f"✅ Replenishment saved for {date} (Store {store_id})", "success")
-        return redirect(url_for("stock", store_id=store_id))
+        return redirect(url_for("main.stock", store_id=store_id))
 
     # list available stores
-    cur.execute("SELECT DISTINCT store_id FROM sales_transactions WHERE store_id IS NOT NULL ORDER BY store_id")
-    stores = [row[0] for row in cur.fetchall()]
+    stores = list_stores(cur)
 
     # get selected store
     store_id = request.args.get("store_id")
@@ -178,7 +485,7 @@ def stock():
     return render_template("stock.html", stores=stores, ingredients=ingredients, selected_store=store_id)
 
 
-@app.route("/closing", methods=["GET", "POST"])
+@bp.route("/closing", methods=["GET", "POST"])
 def closing():
     conn = get_conn()
     cur = conn.cursor()
@@ -190,7 +497,7 @@ def closing():
 
         if secret != os.getenv("CLOSING_SECRET", "letmein"):
             flash("❌ Invalid secret phrase", "danger")
-            return redirect(url_for("closing", store_id=store_id))
+            return redirect(url_for("main.closing", store_id=store_id))
 
         ingredient_names = request.form.getlist("ingredient_name[]")
         closings = request.form.getlist("closing[]")
@@ -205,12 +512,12 @@ def closing():
             """, (store_id, date, ing, clo))
 
         conn.commit()
+        note_write()
         flash(f"✅ Closing saved for {date} (Store {store_id})", "success")
-        return redirect(url_for("closing", store_id=store_id))
+        return redirect(url_for("main.closing", store_id=store_id))
 
     # list available stores
-    cur.execute("SELECT DISTINCT store_id FROM sales_transactions WHERE store_id IS NOT NULL ORDER BY store_id")
-    stores = [row[0] for row in cur.fetchall()]
+    stores = list_stores(cur)
 
     # get selected store
     store_id = request.args.get("store_id")
@@ -234,7 +541,86 @@ def closing():
 # ---------------------------
 # Variance
 # ---------------------------
-@app.route("/variance", methods=["GET", "POST"])
+# POS rows match manual_mapping on plu_code, machine rows on lower(machine_name).
+# The two sources are disjoint, so each gets its own equi-join branch (hash/index
+# friendly) instead of one OR join. Covers any set of devices and a date range.
+DEVICE_VARIANCE_SQL = """
+    WITH consumed AS (
+        SELECT date, device_id, ingredient_name, SUM(consumed) AS consumed
+        FROM (
+            SELECT st.date, st.device_id, m.ingredient_name, st.quantity * m.volume AS consumed
+            FROM {sales} st
+            JOIN manual_mapping m ON m.plu_code = st.plu_code
+            WHERE st.source = 'POS'
+              AND st.date BETWEEN %(date_from)s AND %(date_to)s
+              AND (%(devices)s::varchar[] IS NULL OR st.device_id = ANY(%(devices)s::varchar[]))
+              AND m.active = true
+              AND (m.device_id IS NULL OR m.device_id = st.device_id)
+            UNION ALL
+            SELECT st.date, st.device_id, m.ingredient_name, st.quantity * m.volume
+            FROM {sales} st
+            JOIN manual_mapping m ON lower(m.machine_name) = lower(st.machine_name)
+            WHERE st.source IN ('Nozzle', 'Robobar')
+              AND st.date BETWEEN %(date_from)s AND %(date_to)s
+              AND (%(devices)s::varchar[] IS NULL OR st.device_id = ANY(%(devices)s::varchar[]))
+              AND m.active = true
+              AND (m.device_id IS NULL OR m.device_id = st.device_id)
+        ) x
+        WHERE device_id IS NOT NULL
+        GROUP BY date, device_id, ingredient_name
+    ),
+    stock AS (
+        SELECT date, device_id, ingredient_name, replenishment, closing
+        FROM daily_stock
+        WHERE date BETWEEN %(date_from)s::date - 1 AND %(date_to)s
+          AND device_id IS NOT NULL
+          AND (%(devices)s::varchar[] IS NULL OR device_id = ANY(%(devices)s::varchar[]))
+    ),
+    keys AS (
+        SELECT date, device_id, ingredient_name FROM consumed
+        UNION
+        SELECT date, device_id, ingredient_name FROM stock WHERE date >= %(date_from)s
+        UNION
+        SELECT date + 1, device_id, ingredient_name FROM stock WHERE date < %(date_to)s
+    )
+    SELECT
+        k.date,
+        k.device_id,
+        k.ingredient_name,
+        COALESCE(y.closing, 0) AS opening,
+        COALESCE(t.replenishment, 0) AS replenishment,
+        COALESCE(c.consumed, 0) AS consumed,
+        (COALESCE(y.closing, 0) + COALESCE(t.replenishment, 0) - COALESCE(c.consumed, 0)) AS expected_closing,
+        t.closing AS physical_closing,
+        (COALESCE(t.closing, 0) -
+         (COALESCE(y.closing, 0) + COALESCE(t.replenishment, 0) - COALESCE(c.consumed, 0))) AS variance
+    FROM keys k
+    LEFT JOIN consumed c
+      ON c.date = k.date AND c.device_id = k.device_id AND c.ingredient_name = k.ingredient_name
+    LEFT JOIN stock t
+      ON t.date = k.date AND t.device_id = k.device_id AND t.ingredient_name = k.ingredient_name
+    LEFT JOIN stock y
+      ON y.date = k.date - 1 AND y.device_id = k.device_id AND y.ingredient_name = k.ingredient_name
+    ORDER BY k.device_id, k.date, k.ingredient_name
+"""
+
+
+DEVICE_VARIANCE_SOURCES = ("POS", "Nozzle", "Robobar")
+
+
+def fetch_device_variance(cur, date_from, date_to, device_ids=None):
+    """Legacy manual_mapping variance per (device, date, ingredient) in one query.
+    device_ids=None means every device."""
+    sales = sales_relation(cur, date_from, date_to, DEVICE_VARIANCE_SOURCES)
+    cur.execute(DEVICE_VARIANCE_SQL.format(sales=sales), {
+        "date_from": date_from,
+        "date_to": date_to,
+        "devices": list(device_ids) if device_ids else None,
+    })
+    return cur.fetchall()
+
+
+@bp.route("/variance", methods=["GET", "POST"])
 def variance():
     rows = []
     device_id = None
@@ -243,67 +629,87 @@ def variance():
         device_id = request.form["device_id"]
         date = request.form["date"]
 
-        conn = get_conn()
+        d = datetime.strptime(date, "%Y-%m-%d").date()
+        conn = get_read_conn()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
-        query = """
-        WITH expanded_sales AS (
-            SELECT
-                m.ingredient_name,
-                st.device_id,
-                SUM(st.quantity * m.volume) AS consumed
-            FROM sales_transactions st
-            JOIN manual_mapping m
-              ON (
-                   (st.source = 'POS' AND st.plu_code = m.plu_code)
-                OR (st.source IN ('Nozzle','Robobar') AND lower(st.machine_name) = lower(m.machine_name))
-              )
-             AND (m.device_id IS NULL OR m.device_id = st.device_id)
-            WHERE st.date = %s
-              AND st.device_id = %s
-              AND m.active = true
-            GROUP BY m.ingredient_name, st.device_id
-        ),
-        yesterday AS (
-            SELECT ingredient_name, closing
-            FROM daily_stock
-            WHERE date = %s::date - interval '1 day'
-              AND device_id = %s
-        ),
-        today AS (
-            SELECT ingredient_name, replenishment, closing
-            FROM daily_stock
-            WHERE date = %s
-              AND device_id = %s
-        )
-        SELECT
-            COALESCE(yesterday.closing, 0) AS opening,
-            COALESCE(today.replenishment, 0) AS replenishment,
-            COALESCE(expanded_sales.consumed, 0) AS consumed,
-            (COALESCE(yesterday.closing, 0) + COALESCE(today.replenishment, 0) - COALESCE(expanded_sales.consumed, 0)) AS expected_closing,
-            today.closing AS physical_closing,
-            (COALESCE(today.closing, 0) -
-             (COALESCE(yesterday.closing, 0) + COALESCE(today.replenishment, 0) - COALESCE(expanded_sales.consumed, 0))) AS variance,
-            COALESCE(expanded_sales.ingredient_name, yesterday.ingredient_name, today.ingredient_name) AS ingredient_name
-        FROM expanded_sales
-        FULL JOIN yesterday ON yesterday.ingredient_name = expanded_sales.ingredient_name
-        FULL JOIN today ON today.ingredient_name = COALESCE(expanded_sales.ingredient_name, yesterday.ingredient_name);
-        """
-        cur.execute(query, (date, device_id, date, device_id, date, device_id))
-        rows = cur.fetchall()
-
+        rows = fetch_device_variance(cur, d, d, [device_id])
         cur.close()
         conn.close()
 
-    conn = get_conn()
+    conn = get_read_conn()
     cur = conn.cursor()
-    cur.execute("SELECT DISTINCT device_id FROM sales_transactions WHERE device_id IS NOT NULL")
-    devices = [row[0] for row in cur.fetchall()]
+    devices = list_devices(cur)
     cur.close()
     conn.close()
 
     return render_template("variance.html", rows=rows, devices=devices, device_id=device_id, date=date)
 
+
+def group_device_variance(rows):
+    """Group fetch_device_variance rows into one entry per device with totals."""
+    groups = []
+    for device_id, items in groupby(rows, key=lambda r: r["device_id"]):
+        items = [dict(r) for r in items]
+        groups.append({
+            "device_id": device_id,
+            "rows": items,
+            "consumed": sum(float(r["consumed"] or 0) for r in items),
+            "abs_variance": sum(abs(float(r["variance"] or 0)) for r in items),
+        })
+    return groups
+
+
+def batch_params():
+    args = request.values
+    today = date.today().strftime("%Y-%m-%d")
+    date_to = datetime.strptime(args.get("date_to") or today, "%Y-%m-%d").date()
+    date_from = datetime.strptime(args.get("date_from") or date_to.strftime("%Y-%m-%d"), "%Y-%m-%d").date()
+    if date_from > date_to:
+        date_from, date_to = date_to, date_from
+    device_ids = [d for d in args.getlist("device_ids") if d]
+    return date_from, date_to, device_ids
+
+
+@bp.route("/variance/batch", methods=["GET", "POST"])
+def variance_batch():
+    date_from, date_to, device_ids = batch_params()
+
+    conn = get_read_conn()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    groups = []
+    if request.method == "POST" or request.args.get("date_to"):
+        groups = group_device_variance(fetch_device_variance(cur, date_from, date_to, device_ids))
+    devices = list_devices(cur)
+    cur.close()
+    conn.close()
+
+    return render_template("variance_batch.html", groups=groups, devices=devices,
+                           date_from=date_from.strftime("%Y-%m-%d"), date_to=date_to.strftime("%Y-%m-%d"),
+                           selected_devices=device_ids)
+
+
+@bp.route("/api/variance/batch")
+def api_variance_batch():
+    date_from, date_to, device_ids = batch_params()
+
+    conn = get_read_conn()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    groups = group_device_variance(fetch_device_variance(cur, date_from, date_to, device_ids))
+    cur.close()
+    conn.close()
+
+    for group in groups:
+        for r in group["rows"]:
+            r["date"] = r["date"].isoformat()
+            for k in ("opening", "replenishment", "consumed", "expected_closing", "physical_closing", "variance"):
+                r[k] = float(r[k]) if r[k] is not None else None
+
+    return jsonify({
+        "date_from": date_from.isoformat(),
+        "date_to": date_to.isoformat(),
+        "devices": groups,
+    })
+
 def normalize_name(raw):
     if not raw:
         return ""
@@ -314,31 +720,50 @@ def normalize_name(raw):
     s = re.sub(r'\s+', ' ', s).strip()        # collapse spaces
     return s
 
-@app.route("/variance/nozzle", methods=["GET", "POST"])
-def variance_nozzle():
-    from psycopg2.extras import RealDictCursor
-    from statistics import mode
-    import re
-    from datetime import datetime, date, timedelta
-    from flask import Response
-    import csv
-    from io import StringIO
+# ---------------------------
+# Nozzle lookups
+# ---------------------------
+def normalize_machine_name(s: str) -> str:
+    if not s:
+        return ""
+    # collapse whitespace, remove non-alphanumerics, lowercase
+    return re.sub(r"[^a-z0-9]+", "", " ".join(s.split()).lower())
 
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+# SQL equivalents of the normalizers, for matching done in the database
+SQL_MACHINE_KEY = "regexp_replace(lower({col}), '[^a-z0-9]+', '', 'g')"  # normalize_machine_name
+SQL_PLU_KEY = "upper(regexp_replace({col}, '[^a-zA-Z0-9]+', '', 'g'))"  # "JB 30-01" -> "JB3001"
+SQL_NAME_KEY = "btrim(regexp_replace(regexp_replace(lower({col}), '[''`´]', '', 'g'), '[^a-z0-9&]+', ' ', 'g'))"  # normalize_name
 
-    # --- Inputs ---
-    selected_date = request.form.get("date") or request.args.get("date") or date.today().strftime("%Y-%m-%d")
-    d = datetime.strptime(selected_date, "%Y-%m-%d").date()
-    d_prev = d - timedelta(days=1)
 
-    def normalize_name(s: str) -> str:
-        if not s:
-            return ""
-        # collapse whitespace, remove non-alphanumerics, lowercase
-        return re.sub(r"[^a-z0-9]+", "", " ".join(s.split()).lower())
+# load_nozzle_lookups() per process, keyed by the nozzle_mapping and
+# plu_consumption versions (mapping_sync bumps both), so reports only reload
+# after a mapping change. Callers treat the lookups as read-only.
+nozzle_lookups_cache = {}
+nozzle_lookups_lock = threading.Lock()
 
-    # --- Load mappings ---
+
+def nozzle_lookups(cur):
+    """load_nozzle_lookups(), reused until the nozzle mapping changes."""
+    c = cur.connection.cursor()
+    c.execute("""
+        SELECT name, version FROM mapping_versions
+        WHERE name IN ('nozzle_mapping', 'plu_consumption')
+        ORDER BY name
+    """)
+    versions = tuple(c.fetchall())
+    c.close()
+    with nozzle_lookups_lock:
+        if nozzle_lookups_cache.get("versions") == versions:
+            return nozzle_lookups_cache["lookups"]
+    lookups = load_nozzle_lookups(cur)
+    with nozzle_lookups_lock:
+        nozzle_lookups_cache.update(versions=versions, lookups=lookups)
+    return lookups
+
+
+def load_nozzle_lookups(cur):
+    """Load active nozzle mappings and the per-PLU consumption vectors into the
+    lookups used by apply_pos_sale / apply_nozzle_sale."""
     cur.execute("""
         SELECT store_id, plu_code, machine_name, ingredient_name, volume
         FROM nozzle_mapping
@@ -346,12 +771,6 @@ def variance_nozzle():
     """)
     nm = cur.fetchall()
 
-    # Direct POS mapping
-    map_plu_direct = {}
-    for r in nm:
-        if r["plu_code"]:
-            map_plu_direct[(r["plu_code"], r["store_id"])] = (r["ingredient_name"], float(r["volume"] or 0))
-
     # Machine mapping (store both exact and normalized machine names)
     map_machine = {}
     for r in nm:
@@ -360,129 +779,80 @@ def variance_nozzle():
         mapping_entry = (r["ingredient_name"], float(r["volume"] or 0))
 
         key_exact = (raw, store)
-        key_norm = (normalize_name(raw), store)
+        key_norm = (normalize_machine_name(raw), store)
 
         for k in [key_exact, key_norm]:
             map_machine.setdefault(k, []).append(mapping_entry)
 
-    # Ingredient unit size
-    per_ing_unit_ml = {}
-    by_ing_store = {}
-    for r in nm:
-        ing, store, vol = r["ingredient_name"], r["store_id"], float(r["volume"] or 0)
-        if vol > 0 and ing:
-            by_ing_store.setdefault((ing, store), []).append(vol)
-    for key, vols in by_ing_store.items():
-        try:
-            per_ing_unit_ml[key] = float(mode(vols))
-        except Exception:
-            per_ing_unit_ml[key] = 30.0
+    # Ingredient unit size (materialized with plu_consumption, so POS and machine agree)
+    cur.execute("SELECT store_id, ingredient_name, unit_ml::float8 AS unit_ml FROM ingredient_unit_ml")
+    per_ing_unit_ml = {(r["ingredient_name"], r["store_id"]): r["unit_ml"] for r in cur.fetchall()}
 
-    # --- Cocktail recipes ---
+    # --- Per-PLU consumption (materialized, see mapping_sync.py) ---
     cur.execute("""
-        SELECT store_id, cocktail_plu, ingredient_name, volume_ml
-        FROM cocktail_recipes
-        WHERE active = true
+        SELECT store_id, plu_code, ingredient_name, ml::float8 AS ml, units::float8 AS units
+        FROM plu_consumption
     """)
-    recipes_rows = cur.fetchall()
-    recipes = {}
-    for r in recipes_rows:
-        recipes.setdefault((r["cocktail_plu"], r["store_id"]), []).append(
-            (r["ingredient_name"], float(r["volume_ml"]))
+    consumption = {}
+    for r in cur.fetchall():
+        consumption.setdefault((r["plu_code"], r["store_id"]), []).append(
+            (r["ingredient_name"], r["ml"], r["units"])
         )
 
-    # --- POS sales ---
-    cur.execute("""
-        SELECT st.plu_code, st.store_id, st.quantity
-        FROM sales_transactions st
-        WHERE st.source = 'POS' AND st.date = %s
-    """, (d,))
-    pos_rows = cur.fetchall()
+    return {
+        "consumption": consumption,
+        "machine": map_machine,
+        "unit_ml": per_ing_unit_ml,
+    }
 
-    pos_units, pos_ml, contrib_map = {}, {}, {}
 
-    for r in pos_rows:
-        plu, store, qty = r["plu_code"], r["store_id"], float(r["quantity"] or 0)
+def apply_pos_sale(lookups, plu, store, qty, pos_units, pos_ml):
+    """Add one POS sale to the per-ingredient unit/ml totals."""
+    for ing, ml, units in lookups["consumption"].get((plu, store), ()):
+        pos_units[ing] = pos_units.get(ing, 0.0) + qty * units
+        pos_ml[ing] = pos_ml.get(ing, 0.0) + qty * ml
 
-        # Pure ingredient PLU
-        direct = map_plu_direct.get((plu, store))
-        if direct:
-            ing, ml_per_unit = direct
-            if ml_per_unit > 0:
-                pos_units[ing] = pos_units.get(ing, 0.0) + qty
-                pos_ml[ing] = pos_ml.get(ing, 0.0) + qty * ml_per_unit
-            continue
 
-        # Cocktail PLU
-        rec = recipes.get((plu, store))
-        if rec:
-            for ing, ml in rec:
-                pos_ml[ing] = pos_ml.get(ing, 0.0) + qty * ml
-                unit_ml = per_ing_unit_ml.get((ing, store), 30.0)
-                units_equiv = (qty * ml / unit_ml)
-                pos_units[ing] = pos_units.get(ing, 0.0) + units_equiv
-                contrib_map.setdefault(ing, []).append(
-                    f"{qty} × {plu} → {ml*qty:.0f} ml ({units_equiv:.1f} units)"
-                )
+def apply_nozzle_sale(lookups, machine_name, store, qty_total_ml, machine_units):
+    """Add one Nozzle dispense to the per-ingredient machine unit totals."""
+    map_machine = lookups["machine"]
+    raw_name = (machine_name or "").strip()
 
-    # --- Machine sales ---
-    cur.execute("""
-        SELECT machine_name, quantity, store_id
-        FROM sales_transactions
-        WHERE source = 'Nozzle' AND date = %s
-    """, (d,))
-    noz_rows = cur.fetchall()
+    key_exact = (raw_name, store)
+    key_norm = (normalize_machine_name(raw_name), store)
 
-    machine_units = {}
-    for r in noz_rows:
-        raw_name = (r["machine_name"] or "").strip()
-        store = r["store_id"]
-        qty_total_ml = float(r["quantity"] or 0)
-
-        key_exact = (raw_name, store)
-        key_norm = (normalize_name(raw_name), store)
-
-        mappings = []
-        if store is None:
-            # No store_id → allow match against any store’s mapping
-            for (mname, mstore), vals in map_machine.items():
-                if mname == raw_name or mname == normalize_name(raw_name):
-                    mappings.extend(vals)
-        else:
-            if key_exact in map_machine:
-                mappings = map_machine[key_exact]
-            elif key_norm in map_machine:
-                mappings = map_machine[key_norm]
-
-        if not mappings:
-            continue
+    mappings = []
+    if store is None:
+        # No store_id → allow match against any store’s mapping
+        for (mname, mstore), vals in map_machine.items():
+            if mname == raw_name or mname == normalize_machine_name(raw_name):
+                mappings.extend(vals)
+    else:
+        if key_exact in map_machine:
+            mappings = map_machine[key_exact]
+        elif key_norm in map_machine:
+            mappings = map_machine[key_norm]
 
-        # --- FIX: Treat quantity as full drink size ---
-        base_size = sum(vol for _, vol in mappings if vol > 0)
-        if base_size <= 0:
-            continue
+    if not mappings:
+        return
 
-        n_servings = qty_total_ml / base_size
+    # --- FIX: Treat quantity as full drink size ---
+    base_size = sum(vol for _, vol in mappings if vol > 0)
+    if base_size <= 0:
+        return
 
-        for ing, vol in mappings:
-            if vol > 0:
-                used_ml = n_servings * vol
-                unit_ml = per_ing_unit_ml.get((ing, store), 30.0)
-                machine_units[ing] = machine_units.get(ing, 0.0) + (used_ml / unit_ml)
+    n_servings = qty_total_ml / base_size
+
+    for ing, vol in mappings:
+        if vol > 0:
+            used_ml = n_servings * vol
+            unit_ml = lookups["unit_ml"].get((ing, store), 30.0)
+            machine_units[ing] = machine_units.get(ing, 0.0) + (used_ml / unit_ml)
 
-    # --- Stock (all stores aggregated) ---
-    cur.execute("""
-        SELECT ingredient_name,
-               SUM(CASE WHEN date = %s THEN closing ELSE 0 END) AS opening,
-               SUM(CASE WHEN date = %s THEN replenishment ELSE 0 END) AS replenishment,
-               SUM(CASE WHEN date = %s THEN closing ELSE 0 END) AS closing
-        FROM daily_stock
-        WHERE date IN (%s, %s)
-        GROUP BY ingredient_name
-    """, (d_prev, d, d, d_prev, d))
-    stock_rows = {r["ingredient_name"]: r for r in cur.fetchall()}
 
-    # --- Final rows ---
+def build_nozzle_rows(stock_rows, pos_units, pos_ml, machine_units, contrib_map=None):
+    """Turn per-ingredient stock and sales totals into the nozzle report rows."""
+    contrib_map = contrib_map or {}
     ingredients = set(stock_rows) | set(pos_units) | set(machine_units)
     rows = []
     for ing in sorted(ingredients):
@@ -509,6 +879,73 @@ def variance_nozzle():
             "variance": round(variance_units, 2),
             "details": contrib_map.get(ing, [])
         })
+    return rows
+
+
+@bp.route("/variance/nozzle", methods=["GET", "POST"])
+def variance_nozzle():
+    # --- Inputs ---
+    selected_date = request.form.get("date") or request.args.get("date") or date.today().strftime("%Y-%m-%d")
+    d = datetime.strptime(selected_date, "%Y-%m-%d").date()
+
+    conn = get_read_conn()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    sales = sales_relation(cur, d, d, ("POS", "Nozzle"))
+    d_prev = d - timedelta(days=1)
+
+    # --- Load mappings ---
+    lookups = nozzle_lookups(cur)
+
+    # --- POS sales (via plu_consumption) ---
+    cur.execute("""
+        SELECT pc.ingredient_name, st.plu_code, pc.source,
+               SUM(st.quantity)::float8 AS qty,
+               SUM(st.quantity * pc.ml)::float8 AS ml,
+               SUM(st.quantity * pc.units)::float8 AS units
+        FROM {sales} st
+        JOIN plu_consumption pc ON pc.store_id = st.store_id AND pc.plu_code = st.plu_code
+        WHERE st.source = 'POS' AND st.date = %s
+        GROUP BY pc.ingredient_name, st.plu_code, pc.source
+        ORDER BY pc.ingredient_name, st.plu_code
+    """.format(sales=sales), (d,))
+
+    pos_units, pos_ml, contrib_map = {}, {}, {}
+
+    for r in cur.fetchall():
+        ing = r["ingredient_name"]
+        pos_units[ing] = pos_units.get(ing, 0.0) + (r["units"] or 0.0)
+        pos_ml[ing] = pos_ml.get(ing, 0.0) + (r["ml"] or 0.0)
+        if r["source"] == "recipe":
+            contrib_map.setdefault(ing, []).append(
+                {"plu_code": r["plu_code"], "qty": r["qty"], "ml": r["ml"] or 0.0, "units": r["units"] or 0.0}
+            )
+
+    # --- Machine sales ---
+    cur.execute("""
+        SELECT machine_name, quantity, store_id
+        FROM {sales} st
+        WHERE source = 'Nozzle' AND date = %s
+    """.format(sales=sales), (d,))
+    noz_rows = cur.fetchall()
+
+    machine_units = {}
+    for r in noz_rows:
+        apply_nozzle_sale(lookups, r["machine_name"], r["store_id"], float(r["quantity"] or 0),
+                          machine_units)
+
+    # --- Stock (all stores aggregated) ---
+    cur.execute("""
+        SELECT ingredient_name,
+               SUM(CASE WHEN date = %s THEN closing ELSE 0 END) AS opening,
+               SUM(CASE WHEN date = %s THEN replenishment ELSE 0 END) AS replenishment,
+               SUM(CASE WHEN date = %s THEN closing ELSE 0 END) AS closing
+        FROM daily_stock
+        WHERE date IN (%s, %s)
+        GROUP BY ingredient_name
+    """, (d_prev, d, d, d_prev, d))
+    stock_rows = {r["ingredient_name"]: r for r in cur.fetchall()}
+
+    rows = build_nozzle_rows(stock_rows, pos_units, pos_ml, machine_units, contrib_map)
 
     cur.close()
     conn.close()
@@ -516,7 +953,8 @@ def variance_nozzle():
     # --- CSV export ---
     if request.args.get("export") == "csv":
         si = StringIO()
-        cw = csv.DictWriter(si, fieldnames=["ingredient_name", "opening", "replenishment", "pos_sales", "machine_sales", "expected_closing", "physical_closing", "variance"])
+        cw = csv.DictWriter(si, fieldnames=["ingredient_name", "opening", "replenishment", "pos_sales", "machine_sales", "expected_closing", "physical_closing", "variance"],
+                            extrasaction="ignore")
         cw.writeheader()
         cw.writerows(rows)
         return Response(
@@ -526,10 +964,325 @@ def variance_nozzle():
         )
 
     return render_template("variance_nozzle.html", rows=rows, selected_date=selected_date)
+
+
+# ---------------------------
+# Nozzle Variance per store (process pool)
+# ---------------------------
+# Default: the CPUs shared out between the web server's worker processes.
+VARIANCE_WORKERS = (int(os.getenv("VARIANCE_WORKERS", "0"))
+                    or max(1, (os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", "1"))))
+VARIANCE_POOL_MIN_STORES = int(os.getenv("VARIANCE_POOL_MIN_STORES", "4"))
+store_pool = None
+store_pool_lock = threading.Lock()
+
+
+def get_store_pool():
+    """The per-process reconcile pool. Its workers come from a forkserver (spawn
+    where there is none), never a fork of this threaded web process."""
+    global store_pool
+    with store_pool_lock:
+        if store_pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            store_pool = ProcessPoolExecutor(max_workers=VARIANCE_WORKERS,
+                                             mp_context=multiprocessing.get_context(method))
+        return store_pool
+
+
+def partition_lookups(lookups):
+    """Split load_nozzle_lookups() by store_id in one pass over each map. Rows
+    without a store_id match machine names of any store, so the None partition
+    keeps the full machine map."""
+    by_store = {}
+    for part, entries in lookups.items():
+        for k, v in entries.items():
+            store = by_store.setdefault(k[1], {"consumption": {}, "machine": {}, "unit_ml": {}})
+            store[part][k] = v
+    by_store.setdefault(None, {"consumption": {}, "machine": {}, "unit_ml": {}})["machine"] = lookups["machine"]
+    return by_store
+
+
+def nozzle_lookups_by_store(cur):
+    """partition_lookups() of nozzle_lookups(), computed once per mapping version."""
+    lookups = nozzle_lookups(cur)
+    with nozzle_lookups_lock:
+        cached = nozzle_lookups_cache.get("by_store")
+        if cached and cached[0] is lookups:
+            return cached[1]
+    by_store = partition_lookups(lookups)
+    with nozzle_lookups_lock:
+        nozzle_lookups_cache["by_store"] = (lookups, by_store)
+    return by_store
+
+
+def reconcile_store(task):
+    """Worker: POS and machine unit totals for one store's (plu, qty) and
+    (machine_name, ml) sales."""
+    store_id, lookups, pos_rows, nozzle_rows = task
+    pos_units, pos_ml, machine_units = {}, {}, {}
+    for plu, qty in pos_rows:
+        apply_pos_sale(lookups, plu, store_id, qty, pos_units, pos_ml)
+    for machine_name, qty in nozzle_rows:
+        apply_nozzle_sale(lookups, machine_name, store_id, qty, machine_units)
+    return store_id, pos_units, pos_ml, machine_units
+
+
+def variance_nozzle_by_store(cur, d):
+    """Per-store nozzle reconciliation for day d, plus the all-stores total.
+
+    Sales, stock and mappings are partitioned by store_id in one pass and each
+    store is reconciled on the process pool (in-process below
+    VARIANCE_POOL_MIN_STORES stores). Returns ({store_id: rows}, total_rows).
+    """
+    d_prev = d - timedelta(days=1)
+    sales = sales_relation(cur, d, d, ("POS", "Nozzle"))
+    lookups_by_store = nozzle_lookups_by_store(cur)
+    no_lookups = {"consumption": {}, "machine": {}, "unit_ml": {}}
+
+    # Pre-aggregate per key: both resolutions are linear in quantity.
+    pos_by_store, nozzle_by_store = {}, {}
+    cur.execute("""
+        SELECT store_id, plu_code, SUM(quantity)::float8 AS qty
+        FROM {sales} st
+        WHERE source = 'POS' AND date = %s
+        GROUP BY store_id, plu_code
+    """.format(sales=sales), (d,))
+    for r in cur.fetchall():
+        pos_by_store.setdefault(r["store_id"], []).append((r["plu_code"], r["qty"] or 0.0))
+    cur.execute("""
+        SELECT store_id, machine_name, SUM(quantity)::float8 AS qty
+        FROM {sales} st
+        WHERE source = 'Nozzle' AND date = %s
+        GROUP BY store_id, machine_name
+    """.format(sales=sales), (d,))
+    for r in cur.fetchall():
+        nozzle_by_store.setdefault(r["store_id"], []).append((r["machine_name"], r["qty"] or 0.0))
+
+    stock_by_store = {}
+    cur.execute("""
+        SELECT store_id, ingredient_name,
+               SUM(CASE WHEN date = %s THEN closing ELSE 0 END) AS opening,
+               SUM(CASE WHEN date = %s THEN replenishment ELSE 0 END) AS replenishment,
+               SUM(CASE WHEN date = %s THEN closing ELSE 0 END) AS closing
+        FROM daily_stock
+        WHERE date IN (%s, %s)
+        GROUP BY store_id, ingredient_name
+    """, (d_prev, d, d, d_prev, d))
+    for r in cur.fetchall():
+        stock_by_store.setdefault(r["store_id"], {})[r["ingredient_name"]] = r
+
+    stores = set(pos_by_store) | set(nozzle_by_store) | set(stock_by_store)
+    tasks = [
+        (store, lookups_by_store.get(store, no_lookups), pos_by_store.get(store, []), nozzle_by_store.get(store, []))
+        for store in stores
+    ]
+    if len(tasks) >= VARIANCE_POOL_MIN_STORES and VARIANCE_WORKERS > 1:
+        chunksize = max(1, len(tasks) // (VARIANCE_WORKERS * 4))
+        results = get_store_pool().map(reconcile_store, tasks, chunksize=chunksize)
+    else:
+        results = map(reconcile_store, tasks)
+
+    by_store = {}
+    total_stock, total_pos_units, total_pos_ml, total_machine = {}, {}, {}, {}
+    for store, pos_units, pos_ml, machine_units in results:
+        stock_rows = stock_by_store.get(store, {})
+        by_store[store] = build_nozzle_rows(stock_rows, pos_units, pos_ml, machine_units)
+
+        for ing, s in stock_rows.items():
+            t = total_stock.setdefault(ing, {"opening": 0.0, "replenishment": 0.0, "closing": 0.0})
+            for k in t:
+                t[k] += float(s[k] or 0)
+        for total, part in ((total_pos_units, pos_units), (total_pos_ml, pos_ml), (total_machine, machine_units)):
+            for ing, v in part.items():
+                total[ing] = total.get(ing, 0.0) + v
+
+    total_rows = build_nozzle_rows(total_stock, total_pos_units, total_pos_ml, total_machine)
+    return by_store, total_rows
+
+
+@bp.route("/variance/nozzle/stores", methods=["GET", "POST"])
+def variance_nozzle_stores():
+    selected_date = request.form.get("date") or request.args.get("date") or date.today().strftime("%Y-%m-%d")
+    d = datetime.strptime(selected_date, "%Y-%m-%d").date()
+
+    conn = get_read_conn()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    by_store, total_rows = variance_nozzle_by_store(cur, d)
+    cur.close()
+    conn.close()
+
+    # Stores with a store_id first, unassigned machine rows (None) last
+    stores = sorted(by_store, key=lambda s: (s is None, s or 0))
+
+    # --- CSV export (long format, total as store "ALL") ---
+    if request.args.get("export") == "csv":
+        fields = ["store_id", "ingredient_name", "opening", "replenishment", "pos_sales", "machine_sales",
+                  "expected_closing", "physical_closing", "variance"]
+        si = StringIO()
+        cw = csv.DictWriter(si, fieldnames=fields, extrasaction="ignore")
+        cw.writeheader()
+        for store in stores:
+            cw.writerows({**r, "store_id": store if store is not None else ""} for r in by_store[store])
+        cw.writerows({**r, "store_id": "ALL"} for r in total_rows)
+        return Response(
+            si.getvalue(),
+            mimetype="text/csv",
+            headers={"Content-Disposition": f"attachment;filename=variance_stores_{selected_date}.csv"}
+        )
+
+    return render_template("variance_nozzle_stores.html", stores=stores, by_store=by_store,
+                           total_rows=total_rows, selected_date=selected_date)
+
+
+# ---------------------------
+# Live Variance (today, incremental)
+# ---------------------------
+LIVE_POLL_SECONDS = float(os.getenv("LIVE_VARIANCE_POLL_SECONDS", "5"))
+LIVE_REBUILD_SECONDS = float(os.getenv("LIVE_VARIANCE_REBUILD_SECONDS", "900"))
+LIVE_SETTLE_SECONDS = float(os.getenv("LIVE_VARIANCE_SETTLE_SECONDS", "300"))
+LIVE_CHANNEL = "sales_transactions_insert"
+
+
+class LiveNozzleVariance:
+    """Running POS vs. machine totals per ingredient for the current day.
+
+    New `sales_transactions` rows are folded in by id watermark, so each
+    refresh only reads rows inserted since the previous one. Ids are handed
+    out at insert, not commit, so a lower id can become visible after a higher
+    one: rows above the watermark are re-read (and skipped by id) until they
+    are LIVE_VARIANCE_SETTLE_SECONDS old. Lookups and totals are rebuilt from
+    scratch on day rollover, on reset() (mapping edits) and every
+    LIVE_VARIANCE_REBUILD_SECONDS to pick up loader runs; each rebuild starts
+    a new generation, which the stream sends as a reset event.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.day = None
+        self.generation = 0
+        self.built_at = 0.0
+        self.watermark = 0
+        self.recent = {}
+        self.lookups = None
+        self.pos_units, self.pos_ml, self.machine_units = {}, {}, {}
+
+    def reset(self):
+        with self.lock:
+            self.day = None
+
+    def refresh(self):
+        today = date.today()
+        with self.lock:
+            conn = get_read_conn()
+            try:
+                cur = conn.cursor(cursor_factory=RealDictCursor)
+                if self.day != today or time.time() - self.built_at > LIVE_REBUILD_SECONDS:
+                    self.lookups = nozzle_lookups(cur)
+                    self.day, self.built_at, self.watermark, self.recent = today, time.time(), 0, {}
+                    self.generation += 1
+                    self.pos_units, self.pos_ml, self.machine_units = {}, {}, {}
+
+                cur.execute("SELECT localtimestamp - %s * interval '1 second' AS settled_before",
+                            (LIVE_SETTLE_SECONDS,))
+                settled_before = cur.fetchone()["settled_before"]
+                cur.execute("""
+                    SELECT id, source, plu_code, machine_name, store_id, quantity, created_at
+                    FROM sales_transactions
+                    WHERE date = %s AND id > %s AND source IN ('POS', 'Nozzle')
+                    ORDER BY id
+                """, (today, self.watermark))
+                for r in cur:
+                    if r["id"] in self.recent:
+                        continue
+                    self.recent[r["id"]] = r["created_at"]
+                    qty = float(r["quantity"] or 0)
+                    if r["source"] == "POS":
+                        apply_pos_sale(self.lookups, r["plu_code"], r["store_id"], qty,
+                                       self.pos_units, self.pos_ml)
+                    else:
+                        apply_nozzle_sale(self.lookups, r["machine_name"], r["store_id"], qty,
+                                          self.machine_units)
+                cur.close()
+
+                # Advance the watermark over the leading run of settled rows.
+                for row_id in sorted(self.recent):
+                    created_at = self.recent[row_id]
+                    if created_at is not None and created_at >= settled_before:
+                        break
+                    self.watermark = row_id
+                    del self.recent[row_id]
+            finally:
+                conn.close()
+
+    def snapshot(self):
+        """Return (day, generation, {ingredient: row}) with rounded values."""
+        with self.lock:
+            rows = {}
+            for ing in set(self.pos_units) | set(self.machine_units):
+                pos_units = self.pos_units.get(ing, 0.0)
+                machine_units = self.machine_units.get(ing, 0.0)
+                rows[ing] = {
+                    "ingredient_name": ing,
+                    "pos_sales": round(pos_units, 2),
+                    "pos_ml": round(self.pos_ml.get(ing, 0.0), 2),
+                    "machine_sales": round(machine_units, 2),
+                    "variance": round(pos_units - machine_units, 2),
+                }
+            return self.day, self.generation, rows
+
+
+live_nozzle = LiveNozzleVariance()
+
+
+@bp.route("/variance/live")
+def variance_live():
+    return render_template("variance_live.html", selected_date=date.today().strftime("%Y-%m-%d"))
+
+
+@bp.route("/variance/live/stream")
+def variance_live_stream():
+    def events():
+        # Dedicated autocommit connection so NOTIFYs wake us up between polls;
+        # without the trigger this degrades to plain polling every LIVE_POLL_SECONDS.
+        # Always the primary: a standby does not deliver NOTIFY. Not pooled either:
+        # it is held for the whole stream and LISTEN state must not leak back.
+        listen_conn = connect(current_app.config["DATABASE_URL"])
+        listen_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        listen_conn.cursor().execute(f"LISTEN {LIVE_CHANNEL}")
+
+        sent_generation, sent = None, {}
+        try:
+            while True:
+                live_nozzle.refresh()
+                day, generation, rows = live_nozzle.snapshot()
+
+                # New day, mapping edit or periodic rebuild: ingredients may have gone.
+                if generation != sent_generation:
+                    yield f"event: reset\ndata: {json.dumps({'date': str(day)})}\n\n"
+                    sent_generation, sent = generation, {}
+
+                changed = [row for ing, row in rows.items() if sent.get(ing) != row]
+                if changed:
+                    yield f"event: delta\ndata: {json.dumps(changed)}\n\n"
+                else:
+                    yield ": keepalive\n\n"
+                sent = rows
+
+                if select.select([listen_conn], [], [], LIVE_POLL_SECONDS)[0]:
+                    listen_conn.poll()
+                    listen_conn.notifies.clear()
+        finally:
+            listen_conn.close()
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
  
 
 
-@app.route("/mapping/robobar", methods=["GET", "POST"])
+@bp.route("/mapping/robobar", methods=["GET", "POST"])
 def mapping_robobar():
     conn = get_conn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -551,146 +1304,143 @@ def mapping_robobar():
                     machine_name = EXCLUDED.machine_name
             """, (machine_id, sid, plu_code, digitory_name, machine_name))
 
+        bump_mapping_version(cur, "robobar_mapping")
         conn.commit()
+        note_write()
         flash(f"✅ Robobar mapping saved for {plu_code}", "success")
-        return redirect(url_for("mapping_robobar"))
+        return redirect(url_for("main.mapping_robobar"))
 
     # Existing mappings
-    cur.execute("""
-        SELECT * FROM robobar_mapping
-        ORDER BY store_id, plu_code
-    """)
-    mappings = cur.fetchall()
+    mapping_table = mapping_fragment(cur, "robobar_mapping")
 
     # Distinct stores for selection
-    cur.execute("SELECT DISTINCT store_id FROM sales_transactions WHERE store_id IS NOT NULL ORDER BY store_id")
-    stores = [row[0] for row in cur.fetchall()]
+    stores = list_stores(cur)
 
     cur.close()
     conn.close()
 
-    return render_template("mapping_robobar.html", mappings=mappings, stores=stores)
+    return render_template("mapping_robobar.html", mapping_table=mapping_table, stores=stores)
 
-@app.route("/mapping/robobar/delete", methods=["POST"])
+@bp.route("/mapping/robobar/delete", methods=["POST"])
 def delete_robobar_mappings():
     ids = request.form.getlist("ids")
     if not ids:
         flash("⚠️ No mappings selected for deletion", "warning")
-        return redirect(url_for("mapping_robobar"))
+        return redirect(url_for("main.mapping_robobar"))
 
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("DELETE FROM robobar_mapping WHERE id = ANY(%s)", (ids,))
+    bump_mapping_version(cur, "robobar_mapping")
     conn.commit()
+    note_write()
     cur.close()
     conn.close()
 
     flash(f"❌ Deleted {len(ids)} mappings", "warning")
-    return redirect(url_for("mapping_robobar"))
+    return redirect(url_for("main.mapping_robobar"))
+
+
+# One statement for the whole range: mapped PLUs (so idle ones still show),
+# POS sales of any robobar PLU and machine sales, unioned at row level and
+# grouped by the requested breakdown. robobar_mapping is unique per
+# (store, plu), which gives each POS sale its machine; machine sales match on
+# (store, normalized machine name), or on the name alone when they carry no
+# store, counted once per PLU under its lowest-numbered store's machine.
+# Machine names with no mapping come out as rows with no PLU so they can be
+# mapped.
+ROBOBAR_GROUPS = {
+    "cluster": [],
+    "store": ["store_id"],
+    "machine": ["machine_id"],
+}
+
+ROBOBAR_VARIANCE_SQL = """
+    WITH rm AS (
+        SELECT store_id, machine_id::text AS machine_id, plu_code, machine_name,
+               """ + SQL_MACHINE_KEY.format(col="machine_name") + """ AS mkey
+        FROM robobar_mapping
+    ),
+    rm_name AS (
+        SELECT DISTINCT ON (plu_code, mkey) machine_id, plu_code, machine_name, mkey
+        FROM rm
+        ORDER BY plu_code, mkey, store_id, machine_id
+    ),
+    leaf AS (
+        SELECT store_id, machine_id, plu_code, machine_name, 0::float8 AS pos_units, 0::float8 AS machine_units
+        FROM rm
+        UNION ALL
+        SELECT st.store_id, rm.machine_id, st.plu_code, rm.machine_name, st.quantity::float8, 0
+        FROM {sales} st
+        LEFT JOIN rm ON rm.store_id = st.store_id AND rm.plu_code = st.plu_code
+        WHERE st.source = 'POS' AND st.date BETWEEN %(date_from)s AND %(date_to)s
+          AND st.plu_code IN (SELECT plu_code FROM rm)
+        UNION ALL
+        SELECT st.store_id, COALESCE(rm.machine_id, rn.machine_id, st.device_id),
+               COALESCE(rm.plu_code, rn.plu_code),
+               COALESCE(rm.machine_name, rn.machine_name, st.machine_name), 0, st.quantity::float8
+        FROM {sales} st
+        LEFT JOIN rm ON rm.store_id = st.store_id
+                    AND rm.mkey = """ + SQL_MACHINE_KEY.format(col="st.machine_name") + """
+        LEFT JOIN rm_name rn ON st.store_id IS NULL
+                            AND rn.mkey = """ + SQL_MACHINE_KEY.format(col="st.machine_name") + """
+        WHERE st.source = 'Robobar' AND st.date BETWEEN %(date_from)s AND %(date_to)s
+    )
+    SELECT {keys}plu_code, max(machine_name) AS machine_name,
+           SUM(pos_units) AS pos_sales, SUM(machine_units) AS machine_sales,
+           SUM(pos_units) - SUM(machine_units) AS variance
+    FROM leaf
+    GROUP BY {keys}plu_code, CASE WHEN plu_code IS NULL THEN machine_name END
+    ORDER BY {keys}plu_code NULLS LAST, machine_name
+"""
 
 
-@app.route("/variance/robobar", methods=["GET", "POST"])
-def variance_robobar():
-    from psycopg2.extras import RealDictCursor
-    import re
-    from datetime import datetime, date
+def fetch_robobar_variance(cur, date_from, date_to, group="cluster"):
+    """POS vs Robobar units per PLU over the range, broken down by ROBOBAR_GROUPS[group]."""
+    keys = "".join(f"{k}, " for k in ROBOBAR_GROUPS[group])
+    sql = ROBOBAR_VARIANCE_SQL.format(sales=sales_relation(cur, date_from, date_to, ("POS", "Robobar")), keys=keys)
+    cur.execute(sql, {"date_from": date_from, "date_to": date_to})
+    return cur.fetchall()
 
-    def normalize_name(name: str) -> str:
-        """Aggressive normalization: lowercase, remove all non-alphanumerics."""
-        return re.sub(r"[^a-z0-9]+", "", name.lower()) if name else ""
 
-    conn = get_conn()
+@bp.route("/variance/robobar", methods=["GET", "POST"])
+def variance_robobar():
+    args = request.values
+    today = date.today().strftime("%Y-%m-%d")
+    date_to = datetime.strptime(args.get("date_to") or args.get("date") or today, "%Y-%m-%d").date()
+    date_from = datetime.strptime(args.get("date_from") or date_to.strftime("%Y-%m-%d"), "%Y-%m-%d").date()
+    if date_from > date_to:
+        date_from, date_to = date_to, date_from
+    group = args.get("group") if args.get("group") in ROBOBAR_GROUPS else "cluster"
+
+    conn = get_read_conn()
     cur = conn.cursor(cursor_factory=RealDictCursor)
-
-    # Selected date
-    selected_date = request.form.get("date") or date.today().strftime("%Y-%m-%d")
-    d = datetime.strptime(selected_date, "%Y-%m-%d").date()
-
-    # --- Load robobar mappings ---
-    cur.execute("""
-        SELECT DISTINCT plu_code, machine_name
-        FROM robobar_mapping
-    """)
-    mappings = cur.fetchall()
-
-    # Map plu_code -> normalized machine_name + pretty display
-    mapping_dict = {}
-    for row in mappings:
-        norm_mname = normalize_name(row["machine_name"])
-        mapping_dict[row["plu_code"]] = {
-            "machine_name_display": row["machine_name"],
-            "machine_name_norm": norm_mname
-        }
-
-    # --- POS sales (cluster level) ---
-    cur.execute("""
-        SELECT plu_code, SUM(quantity) as qty
-        FROM sales_transactions
-        WHERE source = 'POS' AND date = %s
-        GROUP BY plu_code
-    """, (d,))
-    pos_rows = cur.fetchall()
-    pos_sales = {row["plu_code"]: float(row["qty"] or 0) for row in pos_rows}
-
-    # --- Robobar machine sales (cluster level) ---
-    cur.execute("""
-        SELECT machine_name, SUM(quantity) as qty
-        FROM sales_transactions
-        WHERE source = 'Robobar' AND date = %s
-        GROUP BY machine_name
-    """, (d,))
-    machine_rows = cur.fetchall()
-
-    machine_sales = {}
-    for row in machine_rows:
-        norm_name = normalize_name(row["machine_name"])
-        qty = float(row["qty"] or 0)
-        machine_sales[norm_name] = machine_sales.get(norm_name, 0) + qty
-
-    # --- Merge by PLU ---
-    rows = []
-    for plu, mapping in mapping_dict.items():
-        pos_qty = pos_sales.get(plu, 0)
-        mach_qty = machine_sales.get(mapping["machine_name_norm"], 0)
-        variance = pos_qty - mach_qty
-
-        rows.append({
-            "plu_code": plu,
-            "machine_name": mapping["machine_name_display"],  # pretty
-            "pos_sales": round(pos_qty, 2),
-            "machine_sales": round(mach_qty, 2),
-            "variance": round(variance, 2)
-        })
-
+    rows = fetch_robobar_variance(cur, date_from, date_to, group)
     cur.close()
     conn.close()
 
-    return render_template("variance_robobar.html", rows=rows, selected_date=selected_date)
+    return render_template("variance_robobar.html", rows=rows, group=group, groups=list(ROBOBAR_GROUPS),
+                           date_from=date_from.strftime("%Y-%m-%d"), date_to=date_to.strftime("%Y-%m-%d"))
 
 
 # ---------------------------
 # Vending Mapping
 # ---------------------------
-@app.route("/mapping/vending", methods=["GET", "POST"])
+@bp.route("/mapping/vending", methods=["GET", "POST"])
 def mapping_vending():
     conn = get_conn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     # List existing mappings
-    cur.execute("""
-        SELECT id, device_id, slot, plu_code, product_name, store_id, multiplier, is_main, created_at
-        FROM vending_mapping
-        ORDER BY device_id, slot, plu_code
-    """)
-    mappings = cur.fetchall()
+    mapping_table = mapping_fragment(cur, "vending_mapping")
 
     cur.close()
     conn.close()
 
-    return render_template("mapping_vending.html", mappings=mappings)
+    return render_template("mapping_vending.html", mapping_table=mapping_table)
 
 
-@app.route("/mapping/vending/delete", methods=["POST"])
+@bp.route("/mapping/vending/delete", methods=["POST"])
 def delete_mappings_vending():
     ids = request.form.getlist("ids[]")
     if ids:
@@ -698,140 +1448,693 @@ def delete_mappings_vending():
         cur = conn.cursor()
         ids = [int(x) for x in ids]
         cur.execute("DELETE FROM vending_mapping WHERE id = ANY(%s)", (ids,))
+        bump_mapping_version(cur, "vending_mapping")
         conn.commit()
+        note_write()
         cur.close()
         conn.close()
         flash(f"❌ Deleted {len(ids)} vending mappings", "warning")
     else:
         flash("⚠️ No mappings selected for deletion", "danger")
 
-    return redirect(url_for("mapping_vending"))
+    return redirect(url_for("main.mapping_vending"))
 
 
 # ---------------------------
 # Vending Variance
 # ---------------------------
-def normalize_plu(plu: str) -> str:
-    if not plu:
-        return ""
-    return re.sub(r"[^a-zA-Z0-9]+", "", plu).upper()
-
-def normalize_name(name: str) -> str:
-    if not name:
-        return ""
-    s = name.lower()
-    s = re.sub(r'[\r\n\t]+', ' ', s)
-    s = re.sub(r"['`´]", "", s)
-    s = re.sub(r'[^a-z0-9&]+', ' ', s)
-    s = re.sub(r'\s+', ' ', s).strip()
-    return s
+# One pass per side over the day's sales, joined to vending_mapping on
+# normalized keys. POS rows match a mapped PLU, else a mapped product name;
+# machine rows match their (device_id, slot). PLUs listed in
+# vending_variance_exclusions are dropped before aggregation.
+# The mapping lookups are shared with the Vending drill-downs.
+VENDING_MAPPING_CTES = """
+    vm AS (
+        SELECT id, device_id, slot, product_name, is_main, COALESCE(multiplier, 1)::float8 AS multiplier,
+               """ + SQL_PLU_KEY.format(col="plu_code") + """ AS plu,
+               """ + SQL_NAME_KEY.format(col="product_name") + """ AS name_key
+        FROM vending_mapping
+    ),
+    plu_names AS (
+        SELECT DISTINCT ON (plu) plu, product_name
+        FROM vm
+        WHERE plu <> ''
+        ORDER BY plu, is_main DESC, id
+    ),
+    name_plus AS (
+        SELECT DISTINCT ON (name_key) name_key, plu
+        FROM vm
+        WHERE name_key <> '' AND plu <> ''
+        ORDER BY name_key, id DESC
+    ),
+    slots AS (
+        SELECT DISTINCT ON (device_id, slot) device_id, slot, plu, multiplier
+        FROM vm
+        ORDER BY device_id, slot, id DESC
+    )
+"""
+
+VENDING_VARIANCE_SQL = "WITH " + VENDING_MAPPING_CTES + """,
+    pos AS (
+        SELECT COALESCE(pn.plu, np.plu) AS plu, SUM(st.quantity)::float8 AS qty
+        FROM {sales} st
+        LEFT JOIN plu_names pn ON pn.plu = """ + SQL_PLU_KEY.format(col="st.plu_code") + """
+        LEFT JOIN name_plus np ON pn.plu IS NULL AND np.name_key = """ + SQL_NAME_KEY.format(col="st.product_name") + """
+        WHERE st.source = 'POS' AND st.date = %(date)s
+          AND COALESCE(pn.plu, np.plu) IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM vending_variance_exclusions x WHERE x.plu_code = COALESCE(pn.plu, np.plu))
+        GROUP BY 1
+    ),
+    machine AS (
+        SELECT s.plu, SUM(st.quantity * s.multiplier)::float8 AS qty
+        FROM {sales} st
+        JOIN slots s ON s.device_id = st.device_id AND s.slot = st.machine_name
+        WHERE st.source = 'Vending' AND st.date = %(date)s
+          AND NOT EXISTS (SELECT 1 FROM vending_variance_exclusions x WHERE x.plu_code = s.plu)
+        GROUP BY s.plu
+    )
+    SELECT plu AS plu_code, pn.product_name,
+           COALESCE(pos.qty, 0) AS pos_sales, COALESCE(machine.qty, 0) AS machine_sales
+    FROM pos
+    FULL JOIN machine USING (plu)
+    JOIN plu_names pn USING (plu)
+    WHERE COALESCE(pos.qty, 0) <> 0 OR COALESCE(machine.qty, 0) <> 0
+    ORDER BY plu
+"""
 
 
-@app.route("/variance/vending", methods=["GET", "POST"])
+@bp.route("/variance/vending", methods=["GET", "POST"])
 def variance_vending():
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
     selected_date = request.form.get("date") or date.today().strftime("%Y-%m-%d")
     d = datetime.strptime(selected_date, "%Y-%m-%d").date()
 
-    # --- Load vending mapping ---
-    cur.execute("""
-        SELECT device_id, slot, plu_code, product_name, multiplier
-        FROM vending_mapping
-    """)
-    mapping_rows = cur.fetchall()
-
-    # Build lookup
-    vending_map = {}
-    mapped_plus = set()
-    mapped_names = {}
-    for row in mapping_rows:
-        plu_norm = normalize_plu(row["plu_code"])
-        name_norm = normalize_name(row["product_name"])
-        key = (str(row["device_id"]), str(row["slot"]))
-        vending_map[key] = {
-            "plu": plu_norm,
-            "name": row["product_name"],
-            "multiplier": float(row["multiplier"] or 1)
-        }
-        mapped_plus.add(plu_norm)
-        mapped_names[name_norm] = plu_norm
-
-    # --- POS sales ---
-    cur.execute("""
-        SELECT plu_code, product_name, SUM(quantity) as qty
-        FROM sales_transactions
-        WHERE source = 'POS' AND date = %s
-        GROUP BY plu_code, product_name
-    """, (d,))
-    pos_rows = cur.fetchall()
-
-    pos_sales = {}
-    for row in pos_rows:
-        plu_norm = normalize_plu(row["plu_code"])
-        name_norm = normalize_name(row["product_name"])
-        qty = float(row["qty"] or 0)
-
-        if plu_norm in mapped_plus:
-            key = plu_norm
-        elif name_norm in mapped_names:
-            key = mapped_names[name_norm]
-        else:
-            continue  # skip if not mapped
-
-        pos_sales[key] = pos_sales.get(key, 0) + qty
-
-    # --- Vending sales ---
-    cur.execute("""
-        SELECT device_id, machine_name, SUM(quantity) as qty
-        FROM sales_transactions
-        WHERE source = 'Vending' AND date = %s
-        GROUP BY device_id, machine_name
-    """, (d,))
-    vending_rows = cur.fetchall()
-
-    machine_sales = {}
-    for row in vending_rows:
-        key = (str(row["device_id"]), str(row["machine_name"]))
-        if key in vending_map:
-            plu = vending_map[key]["plu"]
-            qty = float(row["qty"] or 0) * vending_map[key]["multiplier"]
-            machine_sales[plu] = machine_sales.get(plu, 0) + qty
+    conn = get_read_conn()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    sales = sales_relation(cur, d, d, ("POS", "Vending"))
+    cur.execute(VENDING_VARIANCE_SQL.format(sales=sales), {"date": d})
+
+    rows = []
+    for r in cur.fetchall():
+        rows.append({
+            "plu_code": r["plu_code"],
+            "product_name": r["product_name"] or r["plu_code"],
+            "pos_sales": round(r["pos_sales"], 2),
+            "machine_sales": round(r["machine_sales"], 2),
+            "variance": round(r["pos_sales"] - r["machine_sales"], 2)
+        })
 
     cur.close()
     conn.close()
 
-    # --- Build final rows (only mapped PLUs) ---
-    rows = []
-    for plu in sorted(mapped_plus):
-        pos_qty = pos_sales.get(plu, 0.0)
-        machine_qty = machine_sales.get(plu, 0.0)
-        variance = pos_qty - machine_qty
-
-        # 🔥 Skip products with no activity
-        if pos_qty == 0 and machine_qty == 0:
-            continue
+    return render_template("variance_vending.html", rows=rows, selected_date=selected_date)
 
-        product_name = None
-        for v in vending_map.values():
-            if v["plu"] == plu:
-                product_name = v["name"]
-                break
 
+# ---------------------------
+# Variance Trends (rolling 7/30 day)
+# ---------------------------
+# Nozzle machine side: modal pour size per (store, ingredient) and, per normalized
+# machine name, each ingredient's volume and the drink's total (base_size).
+NOZZLE_MACHINE_CTES = """
+    nm AS (
+        SELECT store_id, machine_name, ingredient_name, volume::float8 AS volume
+        FROM nozzle_mapping
+        WHERE active = true
+    ),
+    mm AS (
+        SELECT store_id, ingredient_name, volume,
+               """ + SQL_MACHINE_KEY.format(col="machine_name") + """ AS mkey,
+               SUM(volume) OVER (PARTITION BY store_id, """ + SQL_MACHINE_KEY.format(col="machine_name") + """) AS base_size
+        FROM nm
+        WHERE volume > 0
+    )
+"""
+
+# Daily POS vs. machine units per (date, store_id, key). Ingredient level follows
+# the nozzle rules (POS via plu_consumption; machine ml split by recipe share and
+# converted with the modal pour size), PLU level follows robobar_mapping.
+TREND_DAILY_SQL = {
+    "ingredient": NOZZLE_MACHINE_CTES + """,
+        daily AS (
+            SELECT date, store_id, key, SUM(pos_units) AS pos_units, SUM(machine_units) AS machine_units
+            FROM (
+                SELECT st.date, st.store_id, pc.ingredient_name AS key,
+                       (st.quantity * pc.units)::float8 AS pos_units, 0::float8 AS machine_units
+                FROM {sales} st
+                JOIN plu_consumption pc ON pc.store_id = st.store_id AND pc.plu_code = st.plu_code
+                WHERE st.source = 'POS' AND st.date BETWEEN %(start)s AND %(end)s
+                UNION ALL
+                SELECT st.date, st.store_id, mm.ingredient_name,
+                       0, st.quantity::float8 / mm.base_size * mm.volume / COALESCE(u.unit_ml, 30)
+                FROM {sales} st
+                JOIN mm ON mm.store_id = st.store_id
+                       AND mm.mkey = """ + SQL_MACHINE_KEY.format(col="st.machine_name") + """
+                LEFT JOIN ingredient_unit_ml u ON u.store_id = mm.store_id AND u.ingredient_name = mm.ingredient_name
+                WHERE st.source = 'Nozzle' AND st.date BETWEEN %(start)s AND %(end)s
+            ) x
+            WHERE %(store_id)s::int IS NULL OR store_id = %(store_id)s::int
+            GROUP BY date, store_id, key
+        )
+    """,
+    "plu": """
+        rm AS (
+            SELECT DISTINCT store_id, plu_code,
+                   """ + SQL_MACHINE_KEY.format(col="machine_name") + """ AS mkey
+            FROM robobar_mapping
+        ),
+        daily AS (
+            SELECT date, store_id, key, SUM(pos_units) AS pos_units, SUM(machine_units) AS machine_units
+            FROM (
+                SELECT st.date, st.store_id, st.plu_code AS key,
+                       st.quantity::float8 AS pos_units, 0::float8 AS machine_units
+                FROM {sales} st
+                WHERE st.source = 'POS' AND st.date BETWEEN %(start)s AND %(end)s
+                  AND EXISTS (
+                      SELECT 1 FROM rm
+                      WHERE rm.store_id = st.store_id AND rm.plu_code = st.plu_code
+                  )
+                UNION ALL
+                SELECT st.date, st.store_id, rm.plu_code, 0, st.quantity::float8
+                FROM {sales} st
+                JOIN rm ON rm.store_id = st.store_id
+                       AND rm.mkey = """ + SQL_MACHINE_KEY.format(col="st.machine_name") + """
+                WHERE st.source = 'Robobar' AND st.date BETWEEN %(start)s AND %(end)s
+            ) x
+            WHERE %(store_id)s::int IS NULL OR store_id = %(store_id)s::int
+            GROUP BY date, store_id, key
+        )
+    """,
+}
+
+TREND_SOURCES = {"ingredient": ("POS", "Nozzle"), "plu": ("POS", "Robobar")}
+
+# Gap-fill every (store, key) to one row per day so ROWS frames are day frames,
+# then take the rolling sums and the latest value per series in the same pass.
+TREND_SQL = """
+    WITH {daily},
+    calendar AS (
+        SELECT k.store_id, k.key, g::date AS date
+        FROM (SELECT DISTINCT store_id, key FROM daily) k
+        CROSS JOIN generate_series(%(start)s::date, %(end)s::date, interval '1 day') g
+    ),
+    filled AS (
+        SELECT c.date, c.store_id, c.key,
+               COALESCE(d.pos_units, 0) AS pos_units,
+               COALESCE(d.machine_units, 0) AS machine_units,
+               COALESCE(d.pos_units, 0) - COALESCE(d.machine_units, 0) AS variance
+        FROM calendar c
+        LEFT JOIN daily d ON d.date = c.date AND d.store_id = c.store_id AND d.key = c.key
+    ),
+    rolling AS (
+        SELECT date, store_id, key, variance,
+               SUM(pos_units) OVER w7 AS pos_7d,
+               SUM(variance) OVER w7 AS variance_7d,
+               SUM(pos_units) OVER w30 AS pos_30d,
+               SUM(variance) OVER w30 AS variance_30d
+        FROM filled
+        WINDOW w7 AS (PARTITION BY store_id, key ORDER BY date ROWS BETWEEN 6 PRECEDING AND CURRENT ROW),
+               w30 AS (PARTITION BY store_id, key ORDER BY date ROWS BETWEEN 29 PRECEDING AND CURRENT ROW)
+    )
+    SELECT store_id, key,
+           MAX(pos_7d) FILTER (WHERE date = %(end)s) AS pos_7d,
+           MAX(variance_7d) FILTER (WHERE date = %(end)s) AS variance_7d,
+           MAX(pos_30d) FILTER (WHERE date = %(end)s) AS pos_30d,
+           MAX(variance_30d) FILTER (WHERE date = %(end)s) AS variance_30d,
+           array_agg(variance ORDER BY date) FILTER (WHERE date >= %(display_start)s) AS daily_variance,
+           array_agg(variance_7d ORDER BY date) FILTER (WHERE date >= %(display_start)s) AS sparkline
+    FROM rolling
+    GROUP BY store_id, key
+    ORDER BY abs(MAX(variance_30d) FILTER (WHERE date = %(end)s)) DESC, store_id, key
+    LIMIT %(top)s
+"""
+
+
+def trend_params():
+    """Parse the shared trend query string / form inputs."""
+    args = request.values
+    level = args.get("level", "ingredient")
+    if level not in TREND_DAILY_SQL:
+        level = "ingredient"
+    end = datetime.strptime(args.get("date") or date.today().strftime("%Y-%m-%d"), "%Y-%m-%d").date()
+    days = max(1, min(int(args.get("days") or 30), 366))
+    top = max(1, min(int(args.get("top") or 25), 500))
+    store_id = int(args["store_id"]) if args.get("store_id") else None
+    return level, end, days, top, store_id
+
+
+def fetch_variance_trends(cur, level, end, days, top, store_id=None):
+    """Top-N (store, key) series by absolute 30-day variance, with sparkline data."""
+    display_start = end - timedelta(days=days - 1)
+    start = display_start - timedelta(days=29)
+    sales = sales_relation(cur, start, end, TREND_SOURCES[level], store_id)
+    daily = TREND_DAILY_SQL[level].format(sales=sales)
+    cur.execute(TREND_SQL.format(daily=daily), {
+        "start": start,
+        "display_start": display_start,
+        "end": end,
+        "top": top,
+        "store_id": store_id,
+    })
+    rows = []
+    for r in cur.fetchall():
+        pos_30d = r["pos_30d"] or 0.0
         rows.append({
-            "plu_code": plu,
-            "product_name": product_name or plu,
-            "pos_sales": round(pos_qty, 2),
-            "machine_sales": round(machine_qty, 2),
-            "variance": round(variance, 2)
+            "store_id": r["store_id"],
+            "key": r["key"],
+            "pos_7d": round(r["pos_7d"] or 0.0, 2),
+            "variance_7d": round(r["variance_7d"] or 0.0, 2),
+            "pos_30d": round(pos_30d, 2),
+            "variance_30d": round(r["variance_30d"] or 0.0, 2),
+            "variance_30d_pct": round(100 * (r["variance_30d"] or 0.0) / pos_30d, 1) if pos_30d else None,
+            "daily_variance": [round(v, 2) for v in r["daily_variance"] or []],
+            "sparkline": [round(v, 2) for v in r["sparkline"] or []],
         })
-    rows = [r for r in rows if r["plu_code"] not in ("JB3001", "DIGI41226")] # remove thwn fixed.
+    return rows
+
+
+@bp.app_template_filter("sparkline")
+def sparkline_points(values, width=120, height=24):
+    """SVG polyline points for a list of numbers."""
+    if not values:
+        return ""
+    lo, hi = min(values + [0]), max(values + [0])
+    span = (hi - lo) or 1
+    step = width / max(len(values) - 1, 1)
+    return " ".join(
+        f"{i * step:.1f},{height - (v - lo) / span * height:.1f}" for i, v in enumerate(values)
+    )
+
+
+@bp.route("/variance/trends", methods=["GET", "POST"])
+def variance_trends():
+    level, end, days, top, store_id = trend_params()
+
+    conn = get_read_conn()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    rows = fetch_variance_trends(cur, level, end, days, top, store_id)
+
+    stores = list_stores(cur)
+    cur.close()
+    conn.close()
+
+    return render_template("variance_trends.html", rows=rows, stores=stores, level=level,
+                           selected_date=end.strftime("%Y-%m-%d"), days=days, top=top,
+                           selected_store=store_id)
+
+
+@bp.route("/api/variance/trends")
+def api_variance_trends():
+    level, end, days, top, store_id = trend_params()
+
+    conn = get_read_conn()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    rows = fetch_variance_trends(cur, level, end, days, top, store_id)
+    cur.close()
+    conn.close()
+
+    return jsonify({
+        "level": level,
+        "date": end.isoformat(),
+        "days": days,
+        "dates": [(end - timedelta(days=i)).isoformat() for i in range(days - 1, -1, -1)],
+        "rows": rows,
+    })
+
+
+# ---------------------------
+# Drill-down (contributing transactions)
+# ---------------------------
+DRILLDOWN_ITERSIZE = int(os.getenv("DRILLDOWN_ITERSIZE", "2000"))
+
+DRILLDOWN_COLUMNS = ["id", "date", "time", "source", "store_id", "device_id", "transaction_id",
+                     "ticket_no", "plu_code", "product_name", "machine_name", "quantity", "amount",
+                     "ml", "units"]
+
+DRILLDOWN_SELECT = """
+    SELECT st.id, st.date, st.time, st.source, st.store_id, st.device_id, st.transaction_id,
+           st.ticket_no, st.plu_code, st.product_name, st.machine_name, st.quantity, st.amount,
+"""
+
+DRILLDOWN_FILTER = """
+    st.date = %(date)s AND (%(store_id)s::int IS NULL OR st.store_id = %(store_id)s::int)
+"""
+
+# (source, key kind) -> rows of that source that feed the report line for the key,
+# with the ml / units each row contributes where the report works in those terms.
+DRILLDOWN_SQL = {
+    ("POS", "ingredient"): DRILLDOWN_SELECT + """
+               (st.quantity * pc.ml)::float8 AS ml, (st.quantity * pc.units)::float8 AS units
+        FROM {sales} st
+        JOIN plu_consumption pc ON pc.store_id = st.store_id AND pc.plu_code = st.plu_code
+        WHERE st.source = 'POS' AND pc.ingredient_name = %(key)s AND """ + DRILLDOWN_FILTER + """
+        ORDER BY st.id
+    """,
+    # Robobar report: POS rows group by their PLU as sold.
+    ("POS", "plu"): DRILLDOWN_SELECT + """
+               NULL::float8 AS ml, st.quantity::float8 AS units
+        FROM {sales} st
+        WHERE st.source = 'POS' AND st.plu_code = %(key)s AND """ + DRILLDOWN_FILTER + """
+        ORDER BY st.id
+    """,
+    # Vending report: a mapped PLU, else a mapped product name, resolved as in
+    # VENDING_VARIANCE_SQL; the key is the report's normalized PLU.
+    ("POS", "vending_plu"): "WITH " + VENDING_MAPPING_CTES + DRILLDOWN_SELECT + """
+               NULL::float8 AS ml, st.quantity::float8 AS units
+        FROM {sales} st
+        LEFT JOIN plu_names pn ON pn.plu = """ + SQL_PLU_KEY.format(col="st.plu_code") + """
+        LEFT JOIN name_plus np ON pn.plu IS NULL AND np.name_key = """ + SQL_NAME_KEY.format(col="st.product_name") + """
+        WHERE st.source = 'POS' AND COALESCE(pn.plu, np.plu) = %(key)s AND """ + DRILLDOWN_FILTER + """
+        ORDER BY st.id
+    """,
+    # Same lookup as apply_nozzle_sale(): every mapping row is filed under its
+    # stripped and its normalized machine name; a store's exact name wins over the
+    # normalized one, store-less rows match every store (unit size falls back to
+    # 30 ml). Each row gets the ingredient's share of the matched volume, so
+    # duplicate mapping rows (one per POS PLU) list a transaction once.
+    ("Nozzle", "ingredient"): """
+        WITH nm_keys AS (
+            SELECT store_id, btrim(machine_name, E' \\t\\r\\n') AS k, ingredient_name, volume::float8 AS volume
+            FROM nozzle_mapping
+            WHERE active = true AND volume > 0
+            UNION ALL
+            SELECT store_id, """ + SQL_MACHINE_KEY.format(col="machine_name") + """, ingredient_name, volume::float8
+            FROM nozzle_mapping
+            WHERE active = true AND volume > 0
+        ),
+        nz AS (
+            SELECT st.*, btrim(st.machine_name, E' \\t\\r\\n') AS sname,
+                   """ + SQL_MACHINE_KEY.format(col="st.machine_name") + """ AS skey
+            FROM {sales} st
+            WHERE st.source = 'Nozzle' AND """ + DRILLDOWN_FILTER + """
+        ),
+        matched AS (
+            SELECT nz.id, m.ingredient_name, m.volume
+            FROM nz JOIN nm_keys m ON m.store_id = nz.store_id AND m.k = nz.sname
+            UNION ALL
+            SELECT nz.id, m.ingredient_name, m.volume
+            FROM nz JOIN nm_keys m ON m.store_id = nz.store_id AND m.k = nz.skey
+            WHERE NOT EXISTS (SELECT 1 FROM nm_keys x WHERE x.store_id = nz.store_id AND x.k = nz.sname)
+            UNION ALL
+            SELECT nz.id, m.ingredient_name, m.volume
+            FROM nz JOIN nm_keys m ON m.k IN (nz.sname, nz.skey)
+            WHERE nz.store_id IS NULL
+        ),
+        shares AS (
+            SELECT id, ingredient_name, SUM(volume) / SUM(SUM(volume)) OVER (PARTITION BY id) AS share
+            FROM matched
+            GROUP BY id, ingredient_name
+        )""" + DRILLDOWN_SELECT + """
+               st.quantity::float8 * sh.share AS ml,
+               st.quantity::float8 * sh.share / COALESCE(u.unit_ml, 30) AS units
+        FROM nz st
+        JOIN shares sh ON sh.id = st.id
+        LEFT JOIN ingredient_unit_ml u ON u.store_id = st.store_id AND u.ingredient_name = sh.ingredient_name
+        WHERE sh.ingredient_name = %(key)s
+        ORDER BY st.id
+    """,
+    ("Robobar", "plu"): DRILLDOWN_SELECT + """
+               NULL::float8 AS ml, st.quantity::float8 AS units
+        FROM {sales} st
+        WHERE st.source = 'Robobar' AND """ + DRILLDOWN_FILTER + """
+          AND """ + SQL_MACHINE_KEY.format(col="st.machine_name") + """ IN (
+              SELECT """ + SQL_MACHINE_KEY.format(col="rm.machine_name") + """
+              FROM robobar_mapping rm
+              WHERE rm.plu_code = %(key)s
+                AND (%(store_id)s::int IS NULL OR rm.store_id = %(store_id)s::int)
+          )
+        ORDER BY st.id
+    """,
+    # Each slot counts for the PLU its latest mapping row gives it.
+    ("Vending", "vending_plu"): "WITH " + VENDING_MAPPING_CTES + DRILLDOWN_SELECT + """
+               NULL::float8 AS ml, st.quantity::float8 * s.multiplier AS units
+        FROM {sales} st
+        JOIN slots s ON s.device_id = st.device_id AND s.slot = st.machine_name
+        WHERE st.source = 'Vending' AND s.plu = %(key)s AND """ + DRILLDOWN_FILTER + """
+        ORDER BY st.id
+    """,
+}
+
+
+def stream_drilldown_rows(conn, sales, source, kind, key, d, store_id):
+    """Yield contributing sales rows through a named (server-side) cursor, fetching
+    DRILLDOWN_ITERSIZE rows per round trip. Closes conn when exhausted."""
+    try:
+        cur = conn.cursor(name="drilldown", cursor_factory=RealDictCursor)
+        cur.itersize = DRILLDOWN_ITERSIZE
+        cur.execute(DRILLDOWN_SQL[(source, kind)].format(sales=sales),
+                    {"date": d, "store_id": store_id, "key": key})
+        for row in cur:
+            yield row
+        cur.close()
+    finally:
+        conn.close()
+
+
+@bp.route("/variance/drilldown")
+def variance_drilldown():
+    source = request.args.get("source", "POS")
+    kind = next((k for k in ("ingredient", "vending_plu", "plu") if request.args.get(k)), "plu")
+    key = request.args.get(kind)
+    if not key or (source, kind) not in DRILLDOWN_SQL:
+        abort(400, "Need source and ingredient or plu; supported: "
+                   + ", ".join(f"{s}/{k}" for s, k in DRILLDOWN_SQL))
+    selected_date = request.args.get("date") or date.today().strftime("%Y-%m-%d")
+    d = datetime.strptime(selected_date, "%Y-%m-%d").date()
+    store_id = int(request.args["store_id"]) if request.args.get("store_id") else None
+
+    # Resolved before streaming starts, so ArchiveReadOnly can still retry on the primary.
+    conn = get_read_conn()
+    try:
+        sales = sales_relation(conn.cursor(), d, d, (source,), store_id)
+    except Exception:
+        conn.close()
+        raise
+    rows = stream_drilldown_rows(conn, sales, source, kind, key, d, store_id)
+
+    # --- CSV export ---
+    if request.args.get("export") == "csv":
+        def generate():
+            si = StringIO()
+            cw = csv.DictWriter(si, fieldnames=DRILLDOWN_COLUMNS)
+            cw.writeheader()
+            for i, row in enumerate(rows, 1):
+                cw.writerow(row)
+                if i % DRILLDOWN_ITERSIZE == 0:
+                    yield si.getvalue()
+                    si.seek(0)
+                    si.truncate()
+            yield si.getvalue()
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype="text/csv",
+            headers={"Content-Disposition": f"attachment;filename=drilldown_{source}_{key}_{selected_date}.csv"}
+        )
+
+    return Response(stream_template(
+        "variance_drilldown.html", rows=rows, source=source, kind=kind, key=key,
+        selected_date=selected_date, store_id=store_id
+    ))
+
+
+# ---------------------------
+# Background jobs
+# ---------------------------
+JOB_LABELS = {
+    "export_nozzle_variance": "Nozzle variance export (date range, per store)",
+    "export_device_variance": "Device variance export (date range)",
+    "load_nozzle_mapping": "Reload nozzle mapping (mapping.json)",
+    "load_cocktail_recipes": "Reload cocktail recipes (mapping.json)",
+    "load_vending_mapping": "Reload vending mapping (vending mapping.json)",
+    "rebuild_plu_consumption": "Rebuild PLU consumption",
+    "archive_sales": "Archive closed months to Parquet",
+}
+
+JOB_COLUMNS = """
+    id, kind, params, status, progress, message, attempts, worker,
+    created_at, started_at, finished_at, result_name, (result IS NOT NULL) AS has_result
+"""
+
+
+@bp.route("/jobs", methods=["GET", "POST"])
+def jobs():
+    conn = get_conn()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+
+    if request.method == "POST":
+        kind = request.form.get("kind")
+        params = {k: v for k, v in request.form.items() if k != "kind" and v}
+        if "device_ids" in request.form:
+            params["device_ids"] = request.form.getlist("device_ids")
+        try:
+            job_id = enqueue_job(cur, kind, params)
+        except ValueError as e:
+            flash(f"❌ {e}", "danger")
+            return redirect(url_for("main.jobs"))
+        conn.commit()
+        note_write()
+        cur.close()
+        conn.close()
+        flash(f"✅ Job {job_id} queued", "success")
+        return redirect(url_for("main.job_status", job_id=job_id))
+
+    cur.execute(f"SELECT {JOB_COLUMNS} FROM jobs ORDER BY id DESC LIMIT 100")
+    job_rows = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    return render_template("jobs.html", jobs=job_rows, labels=JOB_LABELS,
+                           today=date.today().strftime("%Y-%m-%d"))
+
+
+def fetch_job(job_id):
+    conn = get_conn()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = %s", (job_id,))
+    job = cur.fetchone()
+    cur.close()
+    conn.close()
+    if job is None:
+        abort(404)
+    return job
+
+
+@bp.route("/jobs/<int:job_id>")
+def job_status(job_id):
+    return render_template("job.html", job=fetch_job(job_id), labels=JOB_LABELS)
+
+
+@bp.route("/api/jobs/<int:job_id>")
+def api_job_status(job_id):
+    job = dict(fetch_job(job_id))
+    for k in ("created_at", "started_at", "finished_at"):
+        job[k] = job[k].isoformat() if job[k] else None
+    job["progress"] = float(job["progress"] or 0)
+    job["result_url"] = url_for("main.job_result", job_id=job_id) if job["has_result"] else None
+    return jsonify(job)
 
-    return render_template("variance_vending.html", rows=rows, selected_date=selected_date)
 
+@bp.route("/jobs/<int:job_id>/result")
+def job_result(job_id):
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT result, result_name, result_mimetype FROM jobs WHERE id = %s AND status = 'done'", (job_id,))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+    if row is None or row[0] is None:
+        abort(404)
+
+    return Response(
+        bytes(row[0]),
+        mimetype=row[2] or "application/octet-stream",
+        headers={"Content-Disposition": f"attachment;filename={row[1] or f'job_{job_id}'}"}
+    )
+
+
+# ---------------------------
+# Health / readiness
+# ---------------------------
+@bp.route("/healthz")
+def healthz():
+    """Liveness: the process is up and serving requests."""
+    return jsonify({"status": "ok"})
+
+
+@bp.route("/readyz")
+def readyz():
+    """Readiness: warm-up has finished and the primary answers a query."""
+    if not current_app.extensions["ready"].is_set():
+        return jsonify({"status": "warming"}), 503
+    try:
+        conn = get_conn()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+        finally:
+            conn.close()
+    except psycopg2.Error as e:
+        current_app.logger.warning("Readiness check failed: %s", e)
+        return jsonify({"status": "database unavailable"}), 503
+    return jsonify({"status": "ready"})
 
 
+# ---------------------------
+# Application factory
+# ---------------------------
+WARM_UP_RETRY_SECONDS = 5
+
+
+def warm_up(app):
+    """Do the first request's work up front: open the pools, fill the store/device
+    lists, the nozzle lookups (whole and per store), live variance totals and the
+    mapping tables, start the reconcile pool and compile every template."""
+    with app.test_request_context("/"):
+        db_pool("primary")
+        if app.config["REPLICA_DATABASE_URL"] and check_replica()["usable"]:
+            db_pool("replica")
+        conn = get_read_conn()
+        try:
+            cur = conn.cursor()
+            list_stores(cur)
+            list_devices(cur)
+            cur.close()
+        finally:
+            conn.close()
+        live_nozzle.refresh()  # also fills nozzle_lookups()
+        conn = get_conn()
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            nozzle_lookups_by_store(cur)
+            for table in MAPPING_TABLES:
+                mapping_fragment(cur, table)
+            cur.close()
+        finally:
+            conn.close()
+    if VARIANCE_WORKERS > 1:
+        get_store_pool()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def warm_up_until_ready(app):
+    while True:
+        try:
+            warm_up(app)
+        except Exception:
+            app.logger.exception("Warm-up failed, retrying in %ss", WARM_UP_RETRY_SECONDS)
+            time.sleep(WARM_UP_RETRY_SECONDS)
+            continue
+        app.extensions["ready"].set()
+        app.logger.info("Warm-up finished")
+        return
+
+
+def create_app(warm=False, config=None):
+    """Build the app. With warm=True, warm_up() runs in a background thread and
+    /readyz answers 503 until it is done, e.g. one app per worker with
+    gunicorn "app:create_app(warm=True)"."""
+    app = Flask(__name__)
+    app.config.update(
+        SECRET_KEY=os.getenv("SECRET_KEY", "fallbacksecret"),
+        DATABASE_URL=os.getenv("DATABASE_URL"),
+        REPLICA_DATABASE_URL=os.getenv("REPLICA_DATABASE_URL") or None,
+        DB_POOL_MIN=int(os.getenv("DB_POOL_MIN", "2")),
+        DB_POOL_MAX=int(os.getenv("DB_POOL_MAX", "20")),
+        LIST_CACHE_SECONDS=float(os.getenv("LIST_CACHE_SECONDS", "300")),
+    )
+    app.config.update(config or {})
+    app.extensions["db_pools"] = {}
+    app.extensions["db_pools_lock"] = threading.Lock()
+    app.extensions["ready"] = threading.Event()
+    app.register_blueprint(bp)
+
+    if warm:
+        threading.Thread(target=warm_up_until_ready, args=(app,), daemon=True).start()
+    else:
+        app.extensions["ready"].set()
+    return app
+
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app(warm=True).run(debug=True)
@@ -0,0 +1,283 @@
+import argparse
+import hashlib
+import io
+import os
+from datetime import date, timedelta
+from decimal import Decimal
+
+import psycopg2
+import psycopg2.extensions
+from dotenv import load_dotenv
+
+load_dotenv()
+DB_URL = os.getenv("DATABASE_URL")
+ARCHIVE_DIR = os.getenv("SALES_ARCHIVE_DIR", "archive")
+# Months kept in sales_transactions, counting the current one. Three covers the
+# trend report's 30 + 29 day window, so only older reports read the archive.
+ARCHIVE_HOT_MONTHS = int(os.getenv("SALES_ARCHIVE_HOT_MONTHS", "3"))
+# Archive files a database session keeps loaded before starting over.
+ARCHIVE_SESSION_FILES = int(os.getenv("SALES_ARCHIVE_SESSION_FILES", "64"))
+
+COLUMNS = ["id", "source", "store_id", "device_id", "date", "time", "transaction_id", "ticket_no",
+           "record_type", "plu_code", "product_id", "product_name", "machine_name", "quantity",
+           "unit", "amount", "currency", "status", "created_at"]
+
+# Unconstrained numeric in sales_transactions: any scale fits, so they are
+# archived as Postgres renders them and parsed back by COPY on load.
+TEXT_NUMERIC = ("quantity", "amount")
+
+BATCH_ROWS = 50000
+
+def get_conn():
+    return psycopg2.connect(DB_URL)
+
+def arrow_schema():
+    import pyarrow as pa
+
+    types = {
+        "id": pa.int64(), "store_id": pa.int32(), "date": pa.date32(), "time": pa.time64("us"),
+        "created_at": pa.timestamp("us"),
+    }
+    return pa.schema([(c, types.get(c, pa.string())) for c in COLUMNS])
+
+def partition_path(month, source, store_id, part):
+    """Relative path of one archive file, hive-style by month/source/store."""
+    store = "none" if store_id is None else str(store_id)
+    return os.path.join(f"month={month:%Y-%m}", f"source={source}", f"store_id={store}", f"part-{part}.parquet")
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class Fingerprint:
+    """Row count, md5 over the ordered ids and quantity total for one partition."""
+
+    def __init__(self):
+        self.rows = 0
+        self.ids = hashlib.md5()
+        self.quantity = 0
+
+    def add(self, ids, quantities):
+        for i in ids:
+            self.ids.update(f"{',' if self.rows else ''}{i}".encode())
+            self.rows += 1
+        self.quantity += sum(Decimal(q) for q in quantities if q is not None)
+
+    def as_tuple(self):
+        return self.rows, self.ids.hexdigest(), self.quantity
+
+# ---------------------------
+# Export
+# ---------------------------
+PARTITION_FILTER = """
+    date >= %(month)s AND date < (%(month)s::date + interval '1 month')
+    AND source = %(source)s AND store_id IS NOT DISTINCT FROM %(store_id)s
+"""
+
+def export_partition(conn, month, source, store_id):
+    """Write one (month, source, store) partition to Parquet, verify it, record it in
+    sales_archive and delete the rows, all in one REPEATABLE READ transaction.
+    Returns the number of rows archived."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    params = {"month": month, "source": source, "store_id": store_id}
+    cur = conn.cursor()
+    cur.execute("SELECT count(*) FROM sales_archive WHERE month = %(month)s AND source = %(source)s "
+                "AND store_id IS NOT DISTINCT FROM %(store_id)s", params)
+    rel_path = partition_path(month, source, store_id, cur.fetchone()[0])
+    full_path = os.path.join(ARCHIVE_DIR, rel_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+    schema = arrow_schema()
+    written = Fingerprint()
+    src = conn.cursor(name="archive_export")
+    src.itersize = BATCH_ROWS
+    select = ", ".join(f"{col}::text" if col in TEXT_NUMERIC else col for col in COLUMNS)
+    src.execute(f"SELECT {select} FROM sales_transactions WHERE {PARTITION_FILTER} ORDER BY id", params)
+    try:
+        with pq.ParquetWriter(full_path, schema, compression="zstd") as writer:
+            while True:
+                batch = src.fetchmany(BATCH_ROWS)
+                if not batch:
+                    break
+                cols = list(zip(*batch))
+                writer.write_table(pa.table([pa.array(c, type=f.type) for c, f in zip(cols, schema)], schema=schema))
+                written.add(cols[0], cols[COLUMNS.index("quantity")])
+        src.close()
+
+        # --- Verify: file read-back and the hot table must match what was written ---
+        stored = Fingerprint()
+        table = pq.read_table(full_path, columns=["id", "quantity"])
+        stored.add(table.column("id").to_pylist(), table.column("quantity").to_pylist())
+        if stored.as_tuple() != written.as_tuple():
+            raise RuntimeError(f"{rel_path}: read-back {stored.as_tuple()} != written {written.as_tuple()}")
+
+        cur.execute(f"""
+            SELECT count(*), md5(COALESCE(string_agg(id::text, ',' ORDER BY id), '')), COALESCE(sum(quantity), 0)
+            FROM sales_transactions WHERE {PARTITION_FILTER}
+        """, params)
+        if cur.fetchone() != written.as_tuple():
+            raise RuntimeError(f"{rel_path}: table checksum does not match archive {written.as_tuple()}")
+
+        rows, ids_md5, quantity = written.as_tuple()
+        cur.execute("""
+            INSERT INTO sales_archive (month, source, store_id, path, row_count, id_checksum, quantity_sum, file_sha256)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, (month, source, store_id, rel_path, rows, ids_md5, quantity, file_sha256(full_path)))
+        cur.execute(f"DELETE FROM sales_transactions WHERE {PARTITION_FILTER}", params)
+        if cur.rowcount != rows:
+            raise RuntimeError(f"{rel_path}: deleted {cur.rowcount} rows, archived {rows}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        if os.path.exists(full_path):
+            os.remove(full_path)
+        raise
+    finally:
+        cur.close()
+    return rows
+
+def first_hot_month(today=None):
+    month = (today or date.today()).replace(day=1)
+    for _ in range(ARCHIVE_HOT_MONTHS - 1):
+        month = (month - timedelta(days=1)).replace(day=1)
+    return month
+
+def closed_months(cur, before):
+    cur.execute("""
+        SELECT DISTINCT date_trunc('month', date)::date
+        FROM sales_transactions
+        WHERE date < %s
+        ORDER BY 1
+    """, (before,))
+    return [r[0] for r in cur.fetchall()]
+
+def archive_sales(before=None, dry_run=False, progress=None):
+    """Archive every month strictly before `before` (default: first_hot_month())."""
+    before = before or first_hot_month()
+    conn = get_conn()
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ)
+    cur = conn.cursor()
+    total = 0
+    months = closed_months(cur, before)
+    for i, month in enumerate(months, 1):
+        cur.execute("""
+            SELECT source, store_id, count(*)
+            FROM sales_transactions
+            WHERE date >= %s AND date < (%s::date + interval '1 month')
+            GROUP BY source, store_id
+            ORDER BY source, store_id
+        """, (month, month))
+        partitions = cur.fetchall()
+        conn.commit()
+        for source, store_id, count in partitions:
+            if dry_run:
+                print(f"  {partition_path(month, source, store_id, 0)}: {count} rows")
+                continue
+            total += export_partition(conn, month, source, store_id)
+        if progress:
+            progress(i, len(months))
+    cur.close()
+    conn.close()
+    return total
+
+# ---------------------------
+# Read path
+# ---------------------------
+class ArchiveReadOnly(Exception):
+    """The range reaches archived months but the session is read-only (a replica),
+    where the temp table they are loaded into cannot be created."""
+
+def load_archive_files(c, paths):
+    """Make sure archived_sales holds every file in `paths`. Files stay loaded for
+    the rest of the database session (keyed by path and mtime), so a pooled
+    connection reads each Parquet file once; they are streamed in BATCH_ROWS
+    batches, never held whole in memory."""
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS archived_sales (LIKE sales_transactions, archive_path text)")
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS archived_files (path text PRIMARY KEY, mtime float8 NOT NULL)")
+    c.execute("SELECT path, mtime FROM archived_files")
+    loaded = dict(c.fetchall())
+    mtimes = {path: os.path.getmtime(os.path.join(ARCHIVE_DIR, path)) for path in paths}
+    missing = [path for path in paths if loaded.get(path) != mtimes[path]]
+    if not missing:
+        return
+    if len(loaded) + len(missing) > ARCHIVE_SESSION_FILES:
+        c.execute("TRUNCATE archived_sales, archived_files")
+        missing = paths
+    else:
+        stale = [path for path in missing if path in loaded]
+        c.execute("DELETE FROM archived_sales WHERE archive_path = ANY(%s)", (stale,))
+        c.execute("DELETE FROM archived_files WHERE path = ANY(%s)", (stale,))
+
+    columns = ", ".join(COLUMNS + ["archive_path"])
+    for path in missing:
+        for batch in pq.ParquetFile(os.path.join(ARCHIVE_DIR, path)).iter_batches(batch_size=BATCH_ROWS):
+            table = pa.Table.from_batches([batch]).append_column(
+                "archive_path", pa.array([path] * batch.num_rows, pa.string()))
+            buf = io.BytesIO()
+            pacsv.write_csv(table, buf)
+            buf.seek(0)
+            c.copy_expert(f"COPY archived_sales ({columns}) FROM STDIN WITH (FORMAT csv, HEADER true)", buf)
+        c.execute("INSERT INTO archived_files (path, mtime) VALUES (%s, %s)", (path, mtimes[path]))
+    c.execute("ANALYZE archived_sales")
+    # Commit so the loaded files outlive this request's transaction.
+    c.connection.commit()
+
+def sales_relation(cur, date_from, date_to, sources=None, store_id=None):
+    """Return a FROM-clause relation covering sales_transactions for the range.
+
+    When part of the range has been archived, the matching Parquet partitions
+    (only the given `sources`, and only `store_id` plus store-less rows when set)
+    are loaded into a session temp table and unioned with the hot table, so
+    report SQL written against `{sales}` works unchanged. Otherwise this is just
+    sales_transactions. Loading commits the caller's transaction; on a read-only
+    session it raises ArchiveReadOnly instead.
+    """
+    c = cur.connection.cursor()
+    c.execute("""
+        SELECT path FROM sales_archive
+        WHERE month BETWEEN date_trunc('month', %(date_from)s::date) AND %(date_to)s
+          AND (%(sources)s::text[] IS NULL OR source = ANY(%(sources)s::text[]))
+          AND (%(store_id)s::int IS NULL OR store_id = %(store_id)s::int OR store_id IS NULL)
+        ORDER BY path
+    """, {"date_from": date_from, "date_to": date_to, "sources": list(sources) if sources else None,
+          "store_id": store_id})
+    paths = [r[0] for r in c.fetchall()]
+    if not paths:
+        c.close()
+        return "sales_transactions"
+
+    c.execute("SHOW transaction_read_only")
+    if c.fetchone()[0] == "on":
+        c.close()
+        raise ArchiveReadOnly(f"{len(paths)} archived partitions needed for {date_from}..{date_to}")
+    load_archive_files(c, paths)
+    columns = ", ".join(COLUMNS)
+    relation = c.mogrify(f"""(
+        SELECT {columns} FROM sales_transactions
+        UNION ALL
+        SELECT {columns} FROM archived_sales
+        WHERE archive_path = ANY(%s) AND date BETWEEN %s AND %s
+    )""", (paths, date_from, date_to)).decode()
+    c.close()
+    return relation
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive closed months of sales_transactions to Parquet.")
+    parser.add_argument("--before", help="first month to keep hot, YYYY-MM "
+                                         "(default: the last SALES_ARCHIVE_HOT_MONTHS months stay hot)")
+    parser.add_argument("--dry-run", action="store_true", help="list partitions without exporting")
+    args = parser.parse_args()
+
+    before = date.fromisoformat(args.before + "-01") if args.before else None
+    rows = archive_sales(before, args.dry_run)
+    if not args.dry_run:
+        print(f"✅ Archived {rows} rows to {ARCHIVE_DIR}.")
@@ -0,0 +1,204 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import psycopg2
+import psycopg2.extensions
+
+import gen_data
+
+# Fixed last day so runs at different dates generate and query the same data.
+BENCH_END = date(2025, 6, 30)
+DEFAULT_SCALES = "2x7x100,5x30x300,20x30x500"
+
+# (name, method, path, form data) per report; {end} / {week} are filled in per run.
+REPORTS = [
+    ("dashboard", "GET", "/", None),
+    ("variance", "POST", "/variance", {"device_id": "{nozzle_device}", "date": "{end}"}),
+    ("variance_batch", "GET", "/variance/batch?date_from={week}&date_to={end}", None),
+    ("variance_nozzle", "POST", "/variance/nozzle", {"date": "{end}"}),
+    ("variance_nozzle_stores", "GET", "/variance/nozzle/stores?date={end}", None),
+    ("variance_robobar", "POST", "/variance/robobar", {"date_from": "{week}", "date_to": "{end}", "group": "store"}),
+    ("variance_vending", "POST", "/variance/vending", {"date": "{end}"}),
+    ("variance_trends", "GET", "/variance/trends?date={end}&days=30", None),
+]
+
+# ---------------------------
+# Query counting
+# ---------------------------
+# app.connect() passes extra kwargs to psycopg2.connect, so a connection_factory
+# sees every cursor the routes open, whatever cursor_factory they ask for.
+query_count = [0]
+counting_cursors = {}
+
+def counting_cursor(base):
+    if base not in counting_cursors:
+        class Counting(base):
+            def execute(self, *args, **kwargs):
+                query_count[0] += 1
+                return super().execute(*args, **kwargs)
+
+            def executemany(self, *args, **kwargs):
+                query_count[0] += 1
+                return super().executemany(*args, **kwargs)
+
+            def copy_expert(self, *args, **kwargs):
+                query_count[0] += 1
+                return super().copy_expert(*args, **kwargs)
+
+        counting_cursors[base] = Counting
+    return counting_cursors[base]
+
+class CountingConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        kwargs["cursor_factory"] = counting_cursor(kwargs.get("cursor_factory") or self.cursor_factory
+                                                   or psycopg2.extensions.cursor)
+        return super().cursor(*args, **kwargs)
+
+def bench_app():
+    """The Flask app pointed at BENCH_DATABASE_URL (primary only) with counted queries.
+    Pooling and the store/device list cache are off: every scale regenerates the data."""
+    import app as appmod
+
+    connect = appmod.connect
+    appmod.connect = lambda dsn, **kwargs: connect(dsn, connection_factory=CountingConnection, **kwargs)
+    app = appmod.create_app(config={
+        "DATABASE_URL": gen_data.BENCH_DB_URL,
+        "REPLICA_DATABASE_URL": None,
+        "DB_POOL_MAX": 0,
+        "LIST_CACHE_SECONDS": 0,
+    })
+    return app.test_client()
+
+# ---------------------------
+# Runs
+# ---------------------------
+def parse_scale(s):
+    stores, days, tx = (int(x) for x in s.lower().split("x"))
+    return stores, days, tx
+
+def fill(value, params):
+    if isinstance(value, dict):
+        return {k: fill(v, params) for k, v in value.items()}
+    return value.format(**params) if value else value
+
+def run_report(client, method, path, data):
+    query_count[0] = 0
+    t = time.perf_counter()
+    r = client.open(path, method=method, data=data)
+    body = r.get_data()  # drain streamed responses inside the timing
+    return time.perf_counter() - t, query_count[0], r.status_code, len(body)
+
+def bench_scale(client, scale, repeat, seed, only=None):
+    stores, days, tx = parse_scale(scale)
+    print(f"Scale {scale}: generating {stores} stores x {days} days x {tx} sales/day ...")
+    store_list = gen_data.generate(stores, days, tx, seed, BENCH_END, progress=None)
+    # generate() bumps every mapping version, so this also checks that the
+    # warm-up gets through a database with versioned mappings.
+    from app import warm_up
+    warm_up(client.application)
+    params = {
+        "end": BENCH_END.isoformat(),
+        "week": (BENCH_END - timedelta(days=6)).isoformat(),
+        "nozzle_device": store_list[0]["nozzle_device"],
+    }
+
+    results = {}
+    for name, method, path, data in REPORTS:
+        if only and name not in only:
+            continue
+        path, data = fill(path, params), fill(data, params)
+        run_report(client, method, path, data)  # warm-up: caches, process pool, templates
+
+        timings = []
+        for _ in range(repeat):
+            elapsed, queries, status, size = run_report(client, method, path, data)
+            timings.append(elapsed)
+
+        # Separate pass for memory: tracemalloc slows allocation-heavy code down.
+        tracemalloc.start()
+        run_report(client, method, path, data)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[name] = {
+            "median_ms": round(statistics.median(timings) * 1000, 1),
+            "min_ms": round(min(timings) * 1000, 1),
+            "peak_kib": round(peak / 1024),
+            "queries": queries,
+            "status": status,
+            "bytes": size,
+        }
+        r = results[name]
+        print(f"  {name:<24} {r['median_ms']:>9.1f} ms  (min {r['min_ms']:.1f})  "
+              f"{r['peak_kib']:>8} KiB  {r['queries']:>4} queries  HTTP {r['status']}")
+    return results
+
+def compare(results, baseline, tolerance):
+    """Print regressions against a saved run; returns how many were found."""
+    regressions = 0
+    for scale, reports in results.items():
+        for name, r in reports.items():
+            b = baseline.get("results", {}).get(scale, {}).get(name)
+            if not b:
+                continue
+            problems = []
+            if r["median_ms"] > b["median_ms"] * (1 + tolerance):
+                problems.append(f"latency {b['median_ms']} -> {r['median_ms']} ms")
+            if r["peak_kib"] > b["peak_kib"] * (1 + tolerance):
+                problems.append(f"memory {b['peak_kib']} -> {r['peak_kib']} KiB")
+            if r["queries"] > b["queries"]:
+                problems.append(f"queries {b['queries']} -> {r['queries']}")
+            if r["status"] != b["status"]:
+                problems.append(f"HTTP {b['status']} -> {r['status']}")
+            if problems:
+                regressions += 1
+                print(f"❌ {scale} {name}: {', '.join(problems)}")
+    if not regressions:
+        print("✅ No regressions against baseline.")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the report routes on synthetic data (BENCH_DATABASE_URL).")
+    parser.add_argument("--scales", default=DEFAULT_SCALES, help="comma-separated STORESxDAYSxTX_PER_DAY")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per report")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--only", help="comma-separated report names")
+    parser.add_argument("--save", metavar="PATH", help="write results as JSON (e.g. a new baseline)")
+    parser.add_argument("--baseline", metavar="PATH", help="compare against a saved JSON run")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed latency/memory growth (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    if not gen_data.BENCH_DB_URL:
+        parser.error("set BENCH_DATABASE_URL to a scratch database (its tables are truncated)")
+    if gen_data.BENCH_DB_URL == os.getenv("DATABASE_URL"):
+        parser.error("BENCH_DATABASE_URL must not be the app's DATABASE_URL")
+
+    client = bench_app()
+    only = set(args.only.split(",")) if args.only else None
+    results = {scale: bench_scale(client, scale, args.repeat, args.seed, only) for scale in args.scales.split(",")}
+
+    run = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "end": BENCH_END.isoformat(),
+        },
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(run, f, indent=2)
+        print(f"✅ Saved results to {args.save}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare(results, baseline, args.tolerance) else 0)
@@ -0,0 +1,267 @@
+import argparse
+import csv
+import json
+import os
+import random
+from datetime import date, time, timedelta
+from io import StringIO
+
+import psycopg2
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+from mapping_sync import bump_mapping_version, rebuild_plu_consumption
+
+load_dotenv()
+# Scratch database only: every run truncates the sales, stock and mapping tables.
+BENCH_DB_URL = os.getenv("BENCH_DATABASE_URL")
+
+TABLES = ["sales_transactions", "daily_stock", "nozzle_mapping", "cocktail_recipes", "robobar_mapping",
+          "vending_mapping", "manual_mapping", "ingredient_unit_ml", "plu_consumption", "sales_archive"]
+
+SALES_COLUMNS = ["source", "store_id", "device_id", "date", "time", "transaction_id", "ticket_no",
+                 "plu_code", "product_name", "machine_name", "quantity", "unit", "amount", "currency", "status"]
+
+# Share of POS sales per product family, and how often the machine side goes
+# missing / gets an extra pour, so every report has some variance to show.
+PRODUCT_MIX = {"nozzle": 0.6, "robobar": 0.2, "vending": 0.2}
+MISSED_POUR = 0.03
+EXTRA_POUR = 0.02
+
+def get_conn():
+    return psycopg2.connect(BENCH_DB_URL)
+
+def load_templates():
+    """The real mapping files, used as the shape for every synthetic store."""
+    with open("mapping.json") as f:
+        nozzle = json.load(f)
+    with open("vending mapping.json") as f:
+        vending = json.load(f)
+    with open("robomap.json") as f:
+        robobar = json.load(f)
+    return nozzle, vending, robobar
+
+# ---------------------------
+# Mappings (same rules as load.py / load_recipe.py / loadvending.py)
+# ---------------------------
+def base_cups(machine_item):
+    return [cup for cup in machine_item.get("cups", {}).values() if cup.get("base_multiplier", 1) == 1]
+
+def mapping_rows(stores, nozzle, vending, robobar):
+    rows = {"nozzle_mapping": [], "cocktail_recipes": [], "robobar_mapping": [], "vending_mapping": [],
+            "manual_mapping": []}
+    for store in stores:
+        for entry in nozzle:
+            for pos in entry.get("pos_items", []):
+                plu = pos.get("plu_code")
+                for m in entry.get("machine_items", []):
+                    machine_name = m.get("name", "").strip()
+                    for cup in base_cups(m):
+                        materials = cup.get("materials", [])
+                        for mat in materials:
+                            ingredient = mat["name"].strip()
+                            volume = float(mat.get("volume", 0) or 0)
+                            rows["nozzle_mapping"].append((store["id"], plu, machine_name, ingredient, volume))
+                            if plu and len(materials) > 1:
+                                rows["cocktail_recipes"].append((store["id"], plu, ingredient, volume))
+
+        for item in robobar:
+            rows["robobar_mapping"].append((store["robobar_machine"], store["id"], item["plucode"],
+                                            item.get("digitory_name"), item.get("machine_name")))
+
+        for block in vending:
+            for item in block.get("items", []):
+                plu = item.get("plucode", "").replace(" ", "").upper()
+                for machine in block.get("machines", []):
+                    for slot in machine.get("slots", []):
+                        rows["vending_mapping"].append((
+                            vending_device(store, machine["machine_id"]), str(slot), plu, item.get("name", "").strip(),
+                            store["id"], float(item.get("multiplier", 1) or 1), bool(item.get("main", True)),
+                        ))
+
+    # Legacy /variance mapping is global (device_id NULL): POS by PLU, machines by name.
+    manual = set()
+    for entry in nozzle:
+        for pos in entry.get("pos_items", []):
+            for m in entry.get("machine_items", []):
+                for cup in base_cups(m):
+                    for mat in cup.get("materials", []):
+                        manual.add((pos.get("plu_code"), m.get("name", "").strip(), None, mat["name"].strip(),
+                                    float(mat.get("volume", 0) or 0)))
+    rows["manual_mapping"] = sorted(manual, key=lambda r: tuple(str(v) for v in r))
+    return rows
+
+def insert_mappings(cur, rows):
+    execute_values(cur, """
+        INSERT INTO nozzle_mapping (store_id, plu_code, machine_name, ingredient_name, volume) VALUES %s
+        ON CONFLICT DO NOTHING
+    """, rows["nozzle_mapping"])
+    execute_values(cur, """
+        INSERT INTO cocktail_recipes (store_id, cocktail_plu, ingredient_name, volume_ml) VALUES %s
+        ON CONFLICT DO NOTHING
+    """, rows["cocktail_recipes"])
+    execute_values(cur, """
+        INSERT INTO robobar_mapping (machine_id, store_id, plu_code, digitory_name, machine_name) VALUES %s
+        ON CONFLICT DO NOTHING
+    """, rows["robobar_mapping"])
+    execute_values(cur, """
+        INSERT INTO vending_mapping (device_id, slot, plu_code, product_name, store_id, multiplier, is_main) VALUES %s
+        ON CONFLICT DO NOTHING
+    """, rows["vending_mapping"])
+    execute_values(cur, """
+        INSERT INTO manual_mapping (plu_code, machine_name, device_id, ingredient_name, volume) VALUES %s
+    """, rows["manual_mapping"])
+
+# ---------------------------
+# Sales and stock
+# ---------------------------
+def catalogue(nozzle, vending, robobar):
+    """Sellable products per family: what the POS rings up and what the machine logs."""
+    products = {"nozzle": [], "robobar": [], "vending": []}
+    for entry in nozzle:
+        machines = [(m.get("name", "").strip(), cups) for m in entry.get("machine_items", []) if (cups := base_cups(m))]
+        for pos in entry.get("pos_items", []):
+            if pos.get("plu_code") and machines:
+                products["nozzle"].append({"plu": pos["plu_code"], "name": pos.get("name"), "machines": machines})
+    for item in robobar:
+        products["robobar"].append({"plu": item["plucode"], "name": item.get("digitory_name"),
+                                    "machine_name": item.get("machine_name")})
+    for block in vending:
+        for item in block.get("items", []):
+            products["vending"].append({
+                "plu": item.get("plucode", "").replace(" ", "").upper(), "name": item.get("name", "").strip(),
+                "multiplier": float(item.get("multiplier", 1) or 1),
+                "slots": [(machine["machine_id"], str(slot)) for machine in block.get("machines", [])
+                          for slot in machine.get("slots", [])],
+            })
+    return {k: v for k, v in products.items() if v}
+
+def day_sales(rng, store, d, tx_per_day, products, tx_counter):
+    """POS rows and matching machine rows for one store-day, plus ml poured per ingredient."""
+    families = list(products)
+    weights = [PRODUCT_MIX[f] for f in families]
+    rows, poured = [], {}
+    for _ in range(tx_per_day):
+        tx_counter[0] += 1
+        tx_id = str(tx_counter[0])
+        family = rng.choices(families, weights)[0]
+        product = rng.choice(products[family])
+        qty = rng.choice((1, 1, 1, 2, 3))
+        minutes = rng.randrange(17 * 60, 26 * 60) % (24 * 60)
+        t = time(minutes // 60, minutes % 60, rng.randrange(60))
+        rows.append(("POS", store["id"], store["pos_device"], d, t, tx_id, f"T{tx_id}", product["plu"],
+                     product["name"], None, qty, "unit", qty * rng.choice((120, 150, 180, 250)), "INR", "completed"))
+
+        pours = qty
+        r = rng.random()
+        if r < MISSED_POUR:
+            pours = 0
+        elif r < MISSED_POUR + EXTRA_POUR:
+            pours = qty + 1
+        if not pours:
+            continue
+
+        if family == "nozzle":
+            machine_name, cups = rng.choice(product["machines"])
+            cup = rng.choice(cups)
+            ml = float(cup.get("total_volume") or sum(m.get("volume", 0) for m in cup["materials"]))
+            rows.append(("Nozzle", store["id"], store["nozzle_device"], d, t, tx_id, None, None, None,
+                         machine_name, ml * pours, "ml", None, None, "completed"))
+            for mat in cup["materials"]:
+                name = mat["name"].strip()
+                poured[name] = poured.get(name, 0.0) + float(mat.get("volume", 0) or 0) * pours
+        elif family == "robobar":
+            rows.append(("Robobar", store["id"], str(store["robobar_machine"]), d, t, tx_id, None, None, None,
+                         product["machine_name"], pours, "unit", None, None, "completed"))
+        else:
+            machine_id, slot = rng.choice(product["slots"])
+            rows.append(("Vending", store["id"], vending_device(store, machine_id), d, t, tx_id, None, None, None,
+                         slot, pours / product["multiplier"], "unit", None, None, "completed"))
+    return rows, poured
+
+def copy_rows(cur, table, columns, rows):
+    buf = StringIO()
+    w = csv.writer(buf)
+    for row in rows:
+        w.writerow("" if v is None else v for v in row)
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+
+def make_stores(n):
+    return [{
+        "id": 1000 + i,
+        "pos_device": f"POS{1000 + i}",
+        "nozzle_device": str(1710000000 + i),
+        "robobar_machine": 62160000 + i,
+    } for i in range(1, n + 1)]
+
+def vending_device(store, machine_id):
+    """Each store gets its own copy of every template vending machine."""
+    return f"{machine_id}-{store['id']}"
+
+def generate(stores=5, days=30, tx_per_day=300, seed=42, end=None, progress=print):
+    """Replace the benchmark database's data with a deterministic synthetic set:
+    `stores` stores x `days` days (ending `end`) x `tx_per_day` POS sales each.
+    Returns the generated store dicts."""
+    end = end or date.today() - timedelta(days=1)
+    start = end - timedelta(days=days - 1)
+    rng = random.Random(seed)
+    nozzle, vending, robobar = load_templates()
+    store_list = make_stores(stores)
+    products = catalogue(nozzle, vending, robobar)
+
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(f"TRUNCATE {', '.join(TABLES)}")
+    insert_mappings(cur, mapping_rows(store_list, nozzle, vending, robobar))
+    rebuild_plu_consumption(cur)
+    bump_mapping_version(cur, "nozzle_mapping", "robobar_mapping", "vending_mapping")
+    conn.commit()
+
+    tx_counter = [0]
+    levels = {}
+    for i in range(days):
+        d = start + timedelta(days=i)
+        sales, stock = [], []
+        for store in store_list:
+            rows, poured = day_sales(rng, store, d, tx_per_day, products, tx_counter)
+            sales.extend(rows)
+            # Book stock in 30 ml units with a little counting noise on the closing.
+            for ingredient in sorted(set(poured) | {k[1] for k in levels if k[0] == store["id"]}):
+                key = (store["id"], ingredient)
+                opening = levels.get(key, 200.0)
+                used = poured.get(ingredient, 0.0) / 30
+                replenishment = float(rng.randrange(0, 60, 10)) if opening - used < 100 else 0.0
+                closing = max(0.0, round(opening + replenishment - used + rng.uniform(-2, 2), 1))
+                levels[key] = closing
+                stock.append((store["id"], store["nozzle_device"], d, ingredient, replenishment, closing))
+        copy_rows(cur, "sales_transactions", SALES_COLUMNS, sales)
+        copy_rows(cur, "daily_stock", ["store_id", "device_id", "date", "ingredient_name", "replenishment", "closing"],
+                  stock)
+        conn.commit()
+        if progress:
+            progress(f"  {d}: {len(sales)} sales rows, {len(stock)} stock rows")
+
+    conn.autocommit = True
+    cur.execute("ANALYZE")
+    cur.close()
+    conn.close()
+    return store_list
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill BENCH_DATABASE_URL with deterministic synthetic data.")
+    parser.add_argument("--stores", type=int, default=5)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--tx-per-day", type=int, default=300, help="POS sales per store per day")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--end", help="last day, YYYY-MM-DD (default: yesterday)")
+    args = parser.parse_args()
+
+    if not BENCH_DB_URL:
+        parser.error("set BENCH_DATABASE_URL to a scratch database (its tables are truncated)")
+    if BENCH_DB_URL == os.getenv("DATABASE_URL"):
+        parser.error("BENCH_DATABASE_URL must not be the app's DATABASE_URL")
+
+    end = date.fromisoformat(args.end) if args.end else None
+    generate(args.stores, args.days, args.tx_per_day, args.seed, end)
+    print(f"✅ Generated {args.stores} stores x {args.days} days x {args.tx_per_day} sales/day.")
@@ -3,6 +3,8 @@ import psycopg2
 import os
 from dotenv import load_dotenv
 
+from mapping_sync import bump_mapping_version, rebuild_plu_consumption
+
 load_dotenv()
 DB_URL = os.getenv("DATABASE_URL")
 
@@ -44,6 +46,8 @@ def load_nozzle_mapping():
                                 ON CONFLICT DO NOTHING
                             """, (store_id, plu, machine_name, ingredient, volume))
 
+    rebuild_plu_consumption(cur)
+    bump_mapping_version(cur, "nozzle_mapping")
     conn.commit()
     cur.close()
     conn.close()
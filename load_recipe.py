@@ -3,6 +3,8 @@ import psycopg2
 import os
 from dotenv import load_dotenv
 
+from mapping_sync import rebuild_plu_consumption
+
 load_dotenv()
 DB_URL = os.getenv("DATABASE_URL")
 
@@ -53,6 +55,7 @@ def load_cocktail_recipes():
                             """, (store_id, plu, ingredient, volume))
                             inserted += 1
 
+    rebuild_plu_consumption(cur)
     conn.commit()
     cur.close()
     conn.close()
@@ -0,0 +1,239 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date, timedelta
+
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+DB_URL = os.getenv("DATABASE_URL")
+
+# The app tags connections "machine-reporting:<endpoint>" while a route holds them;
+# idle pooled connections show up as "machine-reporting:pool".
+APP_NAME_PREFIX = "machine-reporting:"
+
+# name -> (endpoint, method, path, form). {date}, {week}, {store} and {secret}
+# are filled in from the command line. *_save routes write to daily_stock.
+ROUTES = {
+    "dashboard": ("main.dashboard", "GET", "/", None),
+    "variance_nozzle": ("main.variance_nozzle", "GET", "/variance/nozzle?date={date}", None),
+    "variance_nozzle_stores": ("main.variance_nozzle_stores", "GET", "/variance/nozzle/stores?date={date}", None),
+    "variance_robobar": ("main.variance_robobar", "GET", "/variance/robobar?date={date}", None),
+    "variance_vending": ("main.variance_vending", "POST", "/variance/vending", {"date": "{date}"}),
+    "variance_trends": ("main.variance_trends", "GET", "/variance/trends?date={date}", None),
+    "variance_batch": ("main.variance_batch", "GET", "/variance/batch?date_from={week}&date_to={date}", None),
+    "stock": ("main.stock", "GET", "/stock?store_id={store}", None),
+    "closing": ("main.closing", "GET", "/closing?store_id={store}", None),
+    "stock_save": ("main.stock", "POST", "/stock", {
+        "store_id": "{store}", "date": "{date}", "ingredient_name[]": "{ingredient}", "replenishment[]": "10",
+    }),
+    "closing_save": ("main.closing", "POST", "/closing", {
+        "store_id": "{store}", "date": "{date}", "secret": "{secret}", "ingredient_name[]": "{ingredient}",
+        "closing[]": "100",
+    }),
+}
+
+# The 10pm rush: managers mostly reading reports, some entering counts.
+DEFAULT_MIX = ("dashboard:20,variance_nozzle:15,variance_nozzle_stores:5,variance_robobar:8,variance_vending:8,"
+               "variance_trends:4,variance_batch:2,stock:10,closing:10,stock_save:8,closing_save:10")
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Time the route itself; the page a POST redirects to is its own request."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition(":")
+        if name not in ROUTES:
+            raise SystemExit(f"Unknown route {name!r}; choose from {', '.join(ROUTES)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+# ---------------------------
+# Clients
+# ---------------------------
+def client(base_url, requests, mix, deadline, timeout, think, results, lock, seed):
+    opener = urllib.request.build_opener(NoRedirect)
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    while time.monotonic() < deadline:
+        name = rng.choices(names, weights)[0]
+        method, url, body = requests[name]
+        req = urllib.request.Request(url, data=body, method=method)
+        t = time.perf_counter()
+        error = None
+        try:
+            with opener.open(req, timeout=timeout) as r:
+                r.read()
+                status = r.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+            if status >= 400:
+                error = f"HTTP {status}"
+        except Exception as e:  # timeouts, refused connections
+            status, error = None, type(e).__name__
+        elapsed = time.perf_counter() - t
+        with lock:
+            results.append((name, elapsed, status, error))
+        if think:
+            time.sleep(rng.uniform(0, 2 * think))
+
+def sample_connections(stop, interval, samples):
+    """Count app connections per endpoint in pg_stat_activity until stop is set."""
+    conn = psycopg2.connect(DB_URL, application_name="machine-reporting-loadtest")
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        while not stop.wait(interval):
+            cur.execute("""
+                SELECT substr(application_name, %s), count(*)
+                FROM pg_stat_activity
+                WHERE application_name LIKE %s
+                GROUP BY 1
+            """, (len(APP_NAME_PREFIX) + 1, APP_NAME_PREFIX + "%"))
+            samples.append(dict(cur.fetchall()))
+    finally:
+        cur.close()
+        conn.close()
+
+# ---------------------------
+# Report
+# ---------------------------
+def summarize(results, samples, mix, duration):
+    routes = {}
+    for name in mix:
+        rows = [r for r in results if r[0] == name]
+        latencies = sorted(r[1] * 1000 for r in rows)
+        errors = {}
+        for r in rows:
+            if r[3]:
+                errors[r[3]] = errors.get(r[3], 0) + 1
+        endpoint = ROUTES[name][0]
+        conns = [s.get(endpoint, 0) for s in samples]
+        routes[name] = {
+            "requests": len(rows),
+            "rps": round(len(rows) / duration, 2),
+            "errors": sum(errors.values()),
+            "error_rate": round(sum(errors.values()) / len(rows), 4) if rows else None,
+            "error_kinds": errors,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": latencies[-1] if latencies else None,
+            "endpoint": endpoint,
+            "db_conns_peak": max(conns, default=0),
+            "db_conns_avg": round(sum(conns) / len(conns), 2) if conns else 0,
+        }
+    pooled = [s.get("pool", 0) for s in samples]
+    totals = [sum(s.values()) for s in samples]
+    all_latencies = sorted(r[1] * 1000 for r in results)
+    return {
+        "routes": routes,
+        "total": {
+            "requests": len(results),
+            "rps": round(len(results) / duration, 2),
+            "errors": sum(1 for r in results if r[3]),
+            "p50_ms": percentile(all_latencies, 50),
+            "p95_ms": percentile(all_latencies, 95),
+            "p99_ms": percentile(all_latencies, 99),
+            "db_conns_peak": max(totals, default=0),
+            "db_conns_avg": round(sum(totals) / len(totals), 2) if totals else 0,
+            "pool_conns_peak": max(pooled, default=0),
+            "pool_conns_avg": round(sum(pooled) / len(pooled), 2) if pooled else 0,
+        },
+    }
+
+def fmt(ms):
+    return f"{ms:9.1f}" if ms is not None else f"{'-':>9}"
+
+def print_report(summary, clients, duration):
+    print(f"\n{clients} clients, {duration:.0f}s")
+    print(f"{'route':<24}{'reqs':>7}{'req/s':>8}{'err%':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+          f"{'db peak':>9}{'db avg':>8}")
+    for name, r in summary["routes"].items():
+        err = f"{100 * r['error_rate']:.1f}" if r["error_rate"] is not None else "-"
+        print(f"{name:<24}{r['requests']:>7}{r['rps']:>8.1f}{err:>7}{fmt(r['p50_ms'])}{fmt(r['p95_ms'])}"
+              f"{fmt(r['p99_ms'])}{fmt(r['max_ms'])}{r['db_conns_peak']:>9}{r['db_conns_avg']:>8.2f}")
+        if r["error_kinds"]:
+            print(f"{'':<24}errors: {', '.join(f'{k} x{v}' for k, v in r['error_kinds'].items())}")
+    t = summary["total"]
+    print(f"{'TOTAL':<24}{t['requests']:>7}{t['rps']:>8.1f}{'':>7}{fmt(t['p50_ms'])}{fmt(t['p95_ms'])}"
+          f"{fmt(t['p99_ms'])}{'':>9}{t['db_conns_peak']:>9}{t['db_conns_avg']:>8.2f}")
+    print(f"{'  pooled':<24}{'':>7}{'':>8}{'':>7}{'':>9}{'':>9}{'':>9}{'':>9}"
+          f"{t['pool_conns_peak']:>9}{t['pool_conns_avg']:>8.2f}")
+    print("db peak / db avg: app connections per endpoint in pg_stat_activity "
+          "(stock / closing count reads and saves together); pooled: idle pooled connections.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a weighted route mix against a running app with N clients.")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="base URL of the running app")
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="name:weight,... from: " + ", ".join(ROUTES))
+    parser.add_argument("--date", help="report / entry date, YYYY-MM-DD (default: yesterday)")
+    parser.add_argument("--store", default="18", help="store_id for stock / closing")
+    parser.add_argument("--ingredient", default="Vodka", help="ingredient written by the *_save routes")
+    parser.add_argument("--secret", default=os.getenv("CLOSING_SECRET", "letmein"))
+    parser.add_argument("--think", type=float, default=0, help="mean pause between a client's requests, seconds")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="pg_stat_activity polling, seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", metavar="PATH", help="also write the summary as JSON")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    d = date.fromisoformat(args.date) if args.date else date.today() - timedelta(days=1)
+    params = {"date": d.isoformat(), "week": (d - timedelta(days=6)).isoformat(), "store": args.store,
+              "ingredient": args.ingredient, "secret": args.secret}
+    requests = {}
+    for name in mix:
+        _, method, path, form = ROUTES[name]
+        body = urllib.parse.urlencode({k: v.format(**params) for k, v in form.items()}).encode() if form else None
+        requests[name] = (method, args.url.rstrip("/") + path.format(**params), body)
+
+    results, lock = [], threading.Lock()
+    samples, stop = [], threading.Event()
+    sampler = None
+    if DB_URL:
+        sampler = threading.Thread(target=sample_connections, args=(stop, args.sample_interval, samples), daemon=True)
+        sampler.start()
+    else:
+        print("⚠️ DATABASE_URL not set: DB connection counts are skipped.")
+
+    print(f"Running {args.clients} clients for {args.duration:.0f}s against {args.url} ...")
+    started = time.monotonic()
+    deadline = started + args.duration
+    threads = [threading.Thread(target=client, args=(args.url, requests, mix, deadline, args.timeout, args.think,
+                                                     results, lock, args.seed + i))
+               for i in range(args.clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    stop.set()
+    if sampler:
+        sampler.join()
+
+    summary = summarize(results, samples, mix, elapsed)
+    print_report(summary, args.clients, elapsed)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"clients": args.clients, "duration": elapsed, "mix": mix, **summary}, f, indent=2)
+        print(f"✅ Saved summary to {args.json}")
@@ -3,6 +3,8 @@ import psycopg2
 import os
 from dotenv import load_dotenv
 
+from mapping_sync import bump_mapping_version
+
 load_dotenv()
 DB_URL = os.getenv("DATABASE_URL")
 
@@ -45,6 +47,7 @@ def load_vending_mapping():
                             ON CONFLICT (device_id, slot, plu_code, store_id) DO NOTHING
                         """, (device_id, slot_str, plu, name, store_id, multiplier, is_main))
 
+    bump_mapping_version(cur, "vending_mapping")
     conn.commit()
     cur.close()
     conn.close()
@@ -0,0 +1,93 @@
+import psycopg2
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+DB_URL = os.getenv("DATABASE_URL")
+
+def get_conn():
+    return psycopg2.connect(DB_URL)
+
+# One row per (store, ingredient): the modal pour size, on ties the one whose
+# first mapping row came first (what statistics.mode() over the rows gave).
+# Both sides of the nozzle variance convert ml to units with it.
+UNIT_ML_SQL = """
+    INSERT INTO ingredient_unit_ml (store_id, ingredient_name, unit_ml)
+    SELECT DISTINCT ON (store_id, ingredient_name) store_id, ingredient_name, volume
+    FROM nozzle_mapping
+    WHERE active = true AND volume > 0
+      AND (%(stores)s::int[] IS NULL OR store_id = ANY(%(stores)s::int[]))
+    GROUP BY store_id, ingredient_name, volume
+    ORDER BY store_id, ingredient_name, count(*) DESC, min(id)
+"""
+
+# One row per (store, POS PLU, ingredient): how much of the ingredient a single
+# sale of the PLU consumes. A direct nozzle_mapping PLU wins over a recipe (even
+# with volume 0, which maps it to nothing); recipe ml is converted to units with
+# ingredient_unit_ml, falling back to 30 ml.
+PLU_CONSUMPTION_SQL = """
+    WITH nm AS (
+        SELECT id, store_id, plu_code, ingredient_name, volume
+        FROM nozzle_mapping
+        WHERE active = true
+          AND (%(stores)s::int[] IS NULL OR store_id = ANY(%(stores)s::int[]))
+    ),
+    direct AS (
+        SELECT DISTINCT ON (store_id, plu_code) store_id, plu_code, ingredient_name, volume
+        FROM nm
+        WHERE plu_code IS NOT NULL
+        ORDER BY store_id, plu_code, id DESC
+    )
+    INSERT INTO plu_consumption (store_id, plu_code, ingredient_name, ml, units, source)
+    SELECT store_id, plu_code, ingredient_name, volume, 1, 'direct'
+    FROM direct
+    WHERE volume > 0
+    UNION ALL
+    SELECT r.store_id, r.cocktail_plu, r.ingredient_name, r.volume_ml,
+           r.volume_ml / COALESCE(u.unit_ml, 30), 'recipe'
+    FROM cocktail_recipes r
+    LEFT JOIN ingredient_unit_ml u ON u.store_id = r.store_id AND u.ingredient_name = r.ingredient_name
+    WHERE r.active = true
+      AND (%(stores)s::int[] IS NULL OR r.store_id = ANY(%(stores)s::int[]))
+      AND NOT EXISTS (
+          SELECT 1 FROM direct d
+          WHERE d.store_id = r.store_id AND d.plu_code = r.cocktail_plu
+      )
+"""
+
+def rebuild_plu_consumption(cur, store_ids=None):
+    """Recompute ingredient_unit_ml and plu_consumption for the given stores (default:
+    all) inside the caller's transaction. Call after any change to nozzle_mapping or
+    cocktail_recipes."""
+    stores = [int(s) for s in store_ids] if store_ids is not None else None
+    cur.execute("LOCK TABLE ingredient_unit_ml, plu_consumption IN EXCLUSIVE MODE")
+    for table in ("ingredient_unit_ml", "plu_consumption"):
+        cur.execute(f"""
+            DELETE FROM {table}
+            WHERE %(stores)s::int[] IS NULL OR store_id = ANY(%(stores)s::int[])
+        """, {"stores": stores})
+    cur.execute(UNIT_ML_SQL, {"stores": stores})
+    cur.execute(PLU_CONSUMPTION_SQL, {"stores": stores})
+    rows = cur.rowcount
+    bump_mapping_version(cur, "plu_consumption")
+    return rows
+
+def bump_mapping_version(cur, *tables):
+    """Mark mapping tables as changed inside the caller's transaction, so the app
+    re-renders their cached mapping-page fragments and reloads its nozzle lookups.
+    Call with any write to nozzle_mapping, robobar_mapping or vending_mapping
+    (rebuild_plu_consumption() bumps plu_consumption itself)."""
+    for table in tables:
+        cur.execute("""
+            INSERT INTO mapping_versions (name, version, updated_at) VALUES (%s, 1, now())
+            ON CONFLICT (name) DO UPDATE SET version = mapping_versions.version + 1, updated_at = now()
+        """, (table,))
+
+if __name__ == "__main__":
+    conn = get_conn()
+    cur = conn.cursor()
+    rows = rebuild_plu_consumption(cur)
+    conn.commit()
+    cur.close()
+    conn.close()
+    print(f"✅ PLU consumption rebuilt. {rows} rows.")
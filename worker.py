@@ -0,0 +1,286 @@
+import argparse
+import csv
+import json
+import os
+import select
+import socket
+import threading
+import traceback
+from datetime import date, timedelta
+from io import StringIO
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import Json, RealDictCursor
+from dotenv import load_dotenv
+
+load_dotenv()
+DB_URL = os.getenv("DATABASE_URL")
+
+JOBS_CHANNEL = "jobs_queued"
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "5"))
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "600"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# How often a running job's heartbeat_at is refreshed; keep well under JOB_STALE_SECONDS.
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+
+def get_conn():
+    return psycopg2.connect(DB_URL)
+
+# ---------------------------
+# Queue
+# ---------------------------
+def enqueue_job(cur, kind, params=None):
+    """Queue a job inside the caller's transaction; a worker picks it up on commit."""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    c = cur.connection.cursor()
+    c.execute("""
+        INSERT INTO jobs (kind, params) VALUES (%s, %s) RETURNING id
+    """, (kind, Json(params or {})))
+    job_id = c.fetchone()[0]
+    c.execute(f"NOTIFY {JOBS_CHANNEL}")
+    c.close()
+    return job_id
+
+def claim_job(conn, worker_name):
+    """Take the oldest queued job (or one whose worker stopped heartbeating).
+    SKIP LOCKED lets any number of workers poll the same table. Stale jobs that
+    have used up their attempts are failed instead."""
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("""
+        UPDATE jobs
+        SET status = 'failed', finished_at = now(),
+            message = 'Worker ' || COALESCE(worker, '?') || ' stopped heartbeating on attempt ' || attempts
+        WHERE status = 'running' AND heartbeat_at < now() - %s * interval '1 second'
+          AND attempts >= %s
+    """, (JOB_STALE_SECONDS, JOB_MAX_ATTEMPTS))
+    cur.execute("""
+        UPDATE jobs
+        SET status = 'running', worker = %s, attempts = attempts + 1,
+            started_at = now(), heartbeat_at = now(), progress = 0, message = NULL
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE (status = 'queued'
+                   OR (status = 'running' AND heartbeat_at < now() - %s * interval '1 second'))
+              AND attempts < %s
+            ORDER BY id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING id, kind, params
+    """, (worker_name, JOB_STALE_SECONDS, JOB_MAX_ATTEMPTS))
+    job = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return job
+
+def job_progress(conn, job_id, worker_name):
+    """Progress callback for handlers: progress(done, total, message=None)."""
+    def progress(done, total, message=None):
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE jobs SET progress = %s, message = COALESCE(%s, message), heartbeat_at = now()
+            WHERE id = %s AND worker = %s
+        """, (min(1.0, done / total) if total else 1.0, message, job_id, worker_name))
+        conn.commit()
+        cur.close()
+    return progress
+
+def heartbeat(job_id, worker_name, stop):
+    """Refresh heartbeat_at every JOB_HEARTBEAT_SECONDS until stop is set, so a
+    long handler that never reports progress is not reclaimed by another worker.
+    Own connection: the handler may be mid-transaction on the job connection."""
+    conn = get_conn()
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        while not stop.wait(JOB_HEARTBEAT_SECONDS):
+            cur.execute("""
+                UPDATE jobs SET heartbeat_at = now()
+                WHERE id = %s AND worker = %s AND status = 'running'
+            """, (job_id, worker_name))
+    except psycopg2.Error as e:
+        print(f"⚠️ Heartbeat for job {job_id} stopped: {e}")
+    finally:
+        cur.close()
+        conn.close()
+
+def finish_job(conn, job_id, worker_name, result=None, error=None):
+    """Record the outcome, unless another worker has reclaimed the job meanwhile."""
+    cur = conn.cursor()
+    if error is None:
+        name, mimetype, data = result or (None, None, None)
+        cur.execute("""
+            UPDATE jobs
+            SET status = 'done', progress = 1, finished_at = now(),
+                result = %s, result_name = %s, result_mimetype = %s
+            WHERE id = %s AND worker = %s AND status = 'running'
+        """, (psycopg2.Binary(data) if data is not None else None, name, mimetype, job_id, worker_name))
+    else:
+        cur.execute("""
+            UPDATE jobs
+            SET status = CASE WHEN attempts < %s THEN 'queued' ELSE 'failed' END,
+                finished_at = now(), message = %s
+            WHERE id = %s AND worker = %s AND status = 'running'
+        """, (JOB_MAX_ATTEMPTS, error[-4000:], job_id, worker_name))
+    finished = cur.rowcount == 1
+    conn.commit()
+    cur.close()
+    return finished
+
+# ---------------------------
+# Handlers
+# ---------------------------
+# Each handler takes (params, progress) and returns None or
+# (filename, mimetype, bytes) to be stored as the downloadable result.
+def run_load_nozzle_mapping(params, progress):
+    from load import load_nozzle_mapping
+    load_nozzle_mapping()
+
+def run_load_cocktail_recipes(params, progress):
+    from load_recipe import load_cocktail_recipes
+    load_cocktail_recipes()
+
+def run_load_vending_mapping(params, progress):
+    from loadvending import load_vending_mapping
+    load_vending_mapping()
+
+def run_rebuild_plu_consumption(params, progress):
+    from mapping_sync import rebuild_plu_consumption
+    conn = get_conn()
+    cur = conn.cursor()
+    rebuild_plu_consumption(cur)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def run_archive_sales(params, progress):
+    from archive import archive_sales
+    before = date.fromisoformat(params["before"] + "-01") if params.get("before") else None
+    rows = archive_sales(before, progress=progress)
+    progress(1, 1, f"Archived {rows} rows")
+
+def date_range(params):
+    date_to = date.fromisoformat(params.get("date_to") or date.today().isoformat())
+    date_from = date.fromisoformat(params.get("date_from") or date_to.isoformat())
+    return min(date_from, date_to), max(date_from, date_to)
+
+def run_export_nozzle_variance(params, progress):
+    """Per-store and all-stores nozzle variance for every day in the range, as CSV."""
+    from app import variance_nozzle_by_store
+
+    date_from, date_to = date_range(params)
+    days = (date_to - date_from).days + 1
+    fields = ["date", "store_id", "ingredient_name", "opening", "replenishment", "pos_sales", "machine_sales",
+              "expected_closing", "physical_closing", "variance"]
+    si = StringIO()
+    cw = csv.DictWriter(si, fieldnames=fields, extrasaction="ignore")
+    cw.writeheader()
+
+    conn = get_conn()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    for i in range(days):
+        d = date_from + timedelta(days=i)
+        by_store, total_rows = variance_nozzle_by_store(cur, d)
+        conn.rollback()  # end the day's transaction
+        for store in sorted(by_store, key=lambda s: (s is None, s or 0)):
+            cw.writerows({**r, "date": d, "store_id": store if store is not None else ""} for r in by_store[store])
+        cw.writerows({**r, "date": d, "store_id": "ALL"} for r in total_rows)
+        progress(i + 1, days, f"{d}")
+    cur.close()
+    conn.close()
+    return f"variance_nozzle_{date_from}_{date_to}.csv", "text/csv", si.getvalue().encode()
+
+def run_export_device_variance(params, progress):
+    """Legacy manual_mapping variance for all (or the given) devices over the range, as CSV."""
+    from app import fetch_device_variance
+
+    date_from, date_to = date_range(params)
+    conn = get_conn()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    rows = fetch_device_variance(cur, date_from, date_to, params.get("device_ids") or None)
+    cur.close()
+    conn.close()
+
+    si = StringIO()
+    cw = csv.DictWriter(si, fieldnames=["date", "device_id", "ingredient_name", "opening", "replenishment",
+                                        "consumed", "expected_closing", "physical_closing", "variance"])
+    cw.writeheader()
+    cw.writerows(rows)
+    return f"variance_devices_{date_from}_{date_to}.csv", "text/csv", si.getvalue().encode()
+
+JOB_HANDLERS = {
+    "load_nozzle_mapping": run_load_nozzle_mapping,
+    "load_cocktail_recipes": run_load_cocktail_recipes,
+    "load_vending_mapping": run_load_vending_mapping,
+    "rebuild_plu_consumption": run_rebuild_plu_consumption,
+    "archive_sales": run_archive_sales,
+    "export_nozzle_variance": run_export_nozzle_variance,
+    "export_device_variance": run_export_device_variance,
+}
+
+# ---------------------------
+# Worker loop
+# ---------------------------
+def run_job(conn, job, worker_name):
+    progress = job_progress(conn, job["id"], worker_name)
+    stop = threading.Event()
+    beat = threading.Thread(target=heartbeat, args=(job["id"], worker_name, stop), daemon=True)
+    beat.start()
+    try:
+        result = JOB_HANDLERS[job["kind"]](job["params"] or {}, progress)
+    except Exception:
+        conn.rollback()
+        if finish_job(conn, job["id"], worker_name, error=traceback.format_exc()):
+            print(f"❌ Job {job['id']} ({job['kind']}) failed")
+        else:
+            print(f"⚠️ Job {job['id']} ({job['kind']}) failed, but was reclaimed by another worker")
+        return
+    finally:
+        stop.set()
+        beat.join()
+    if finish_job(conn, job["id"], worker_name, result=result):
+        print(f"✅ Job {job['id']} ({job['kind']}) done")
+    else:
+        print(f"⚠️ Job {job['id']} ({job['kind']}) done, but was reclaimed by another worker; result dropped")
+
+def work(once=False):
+    worker_name = f"{socket.gethostname()}:{os.getpid()}"
+    conn = get_conn()
+    listen_conn = get_conn()
+    listen_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    listen_conn.cursor().execute(f"LISTEN {JOBS_CHANNEL}")
+    print(f"👷 Worker {worker_name} waiting for jobs")
+    try:
+        while True:
+            job = claim_job(conn, worker_name)
+            if job:
+                run_job(conn, job, worker_name)
+                continue
+            if once:
+                break
+            if select.select([listen_conn], [], [], JOB_POLL_SECONDS)[0]:
+                listen_conn.poll()
+                listen_conn.notifies.clear()
+    finally:
+        listen_conn.close()
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run queued report / load jobs.")
+    parser.add_argument("--once", action="store_true", help="exit when the queue is empty")
+    parser.add_argument("--enqueue", metavar="KIND", choices=sorted(JOB_HANDLERS), help="queue a job and exit")
+    parser.add_argument("--params", default="{}", help="JSON params for --enqueue")
+    args = parser.parse_args()
+
+    if args.enqueue:
+        conn = get_conn()
+        cur = conn.cursor()
+        job_id = enqueue_job(cur, args.enqueue, json.loads(args.params))
+        conn.commit()
+        cur.close()
+        conn.close()
+        print(f"✅ Queued job {job_id} ({args.enqueue})")
+    else:
+        work(once=args.once)